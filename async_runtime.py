@@ -0,0 +1,352 @@
+import asyncio
+import sys
+import time
+from collections import deque
+
+import numpy as np
+
+import paho.mqtt.client as mqtt
+
+from metrics import NULL_METRICS
+from pipeline import decode_burst, safe_update
+
+# order in which due tasks run within one pass of the scheduler, lowest first
+PRIORITY_FILTER = 0
+PRIORITY_RENDER = 1
+PRIORITY_LOG = 2
+
+
+class ScheduledTask:
+    """
+    A plain function run by the PriorityScheduler
+
+    interval None: run on every pass after `wake`, e.g. new samples arrived
+    interval seconds or a function returning seconds: run periodically
+    """
+
+    def __init__(self, name: str, fn, priority: int, interval=None):
+        self.name = name
+        self.fn = fn
+        self.priority = priority
+        self.interval = interval
+        self.next_run = 0.0
+        self.runs = 0
+
+    def reschedule(self, now: float) -> None:
+        interval = self.interval() if callable(self.interval) else self.interval
+        self.next_run = now + interval
+
+
+class PriorityScheduler:
+    """
+    Runs tasks on the event loop in a fixed priority order
+
+    Each pass runs every due task once, highest priority first, and
+    yields to the loop between tasks so socket reads are never held up
+    by more than one task. An event task returns True when it left work
+    behind (e.g. it hit its batch budget), which schedules another pass
+    straight away instead of waiting for the next wake up.
+    """
+
+    def __init__(self, metrics=NULL_METRICS):
+        self.tasks = []
+        self.metrics = metrics
+        self.passes = 0
+        self._woken = False
+        self._wake_event = None
+        self._running = False
+
+    def add(self, name: str, fn, priority: int, interval=None) -> ScheduledTask:
+        task = ScheduledTask(name, fn, priority, interval)
+        self.tasks.append(task)
+        # stable, so tasks of equal priority keep the order they were added in
+        self.tasks.sort(key=lambda t: t.priority)
+        return task
+
+    def wake(self) -> None:
+        """ Called from loop callbacks when event tasks have work """
+        self._woken = True
+        if self._wake_event is not None:
+            self._wake_event.set()
+
+    def stop(self) -> None:
+        self._running = False
+        self.wake()
+
+    async def run(self) -> None:
+        loop = asyncio.get_running_loop()
+        metrics = self.metrics
+        self._wake_event = asyncio.Event()
+        self._running = True
+        while self._running:
+            woken, self._woken = self._woken, False
+            self._wake_event.clear()
+            for task in self.tasks:
+                if task.interval is None:
+                    if not woken:
+                        continue
+                elif loop.time() < task.next_run:
+                    continue
+                started = time.perf_counter()
+                more = task.fn()
+                task.runs += 1
+                if metrics.enabled:
+                    metrics.observe(f"task_{task.name}", time.perf_counter() - started)
+                if task.interval is None:
+                    if more:
+                        self._woken = True
+                else:
+                    task.reschedule(loop.time())
+                # let pending socket callbacks in before the next task
+                await asyncio.sleep(0)
+                if not self._running:
+                    return
+            self.passes += 1
+
+            if self._woken:
+                continue
+            periodic = [task.next_run for task in self.tasks if task.interval is not None]
+            timeout = min(periodic) - loop.time() if periodic else None
+            if timeout is not None and timeout <= 0:
+                continue
+            try:
+                await asyncio.wait_for(self._wake_event.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+
+class AsyncPipeline:
+    """
+    receive -> decode -> filter on the event loop, a drop in for Pipeline
+
+    `submit` is called from paho's on_message, which runs inside the
+    loop's socket callback, and only appends to a bounded queue. The
+    filter task then decodes and filters at most `budget` payloads per
+    scheduler pass, so rendering and logging still get their turn when
+    the stream is faster than the filter. Everything runs on one thread,
+    nothing touches the estimates concurrently.
+
+    With `batch`, as in Pipeline, the payloads of one pass are decoded
+    and filtered as one sample array. With a `reorder` JitterBuffer,
+    decoded samples are filtered once it releases them, with their dt,
+    and a "release" task drains it when the stream stalls.
+    """
+
+    def __init__(
+        self,
+        scheduler: PriorityScheduler,
+        decode,
+        update,
+        payload_queue_size: int = 256,
+        budget: int = 32,
+        metrics=NULL_METRICS,
+        batch: bool = False,
+        reorder=None,
+    ):
+        self.scheduler = scheduler
+        self.decode = decode
+        self.update = update
+        self.batch = batch
+        self.reorder = reorder
+        self.budget = budget
+        self.payloads = deque(maxlen=payload_queue_size)
+        self.put_count = 0
+        self.dropped = 0
+        self.decode_errors = 0
+        self.update_errors = 0
+        self.samples_filtered = 0
+        # receive time of the sample behind the latest published state
+        self.latest_received = None
+        self._task = None
+
+        self.metrics = metrics
+        metrics.gauge("payload_queue_depth", self.payloads.__len__)
+        metrics.gauge("payloads_dropped", lambda: self.dropped)
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = self.scheduler.add("filter", self.filter_pending, PRIORITY_FILTER)
+            if self.reorder is not None:
+                self.scheduler.add("release", self.release, PRIORITY_FILTER, interval=self._release_interval)
+
+    def stop(self, timeout: float = None) -> None:
+        pass
+
+    def submit(self, payload, received: float = None) -> bool:
+        """ received: time.perf_counter() when the payload arrived """
+        if received is None:
+            received = time.perf_counter()
+        if len(self.payloads) == self.payloads.maxlen:
+            # the deque evicts the oldest payload
+            self.dropped += 1
+        self.payloads.append((received, payload))
+        self.put_count += 1
+        self.scheduler.wake()
+        return True
+
+    def filter_pending(self) -> bool:
+        """ Decode and filter up to `budget` payloads, True if more are waiting """
+        if self.batch:
+            return self._filter_batch()
+        metrics = self.metrics
+        for _ in range(min(self.budget, len(self.payloads))):
+            received, payload = self.payloads.popleft()
+            started = time.perf_counter()
+            try:
+                samples = self.decode(payload)
+            except Exception as e:
+                self.decode_errors += 1
+                print(f"Dropping undecodable payload: {e}")
+                continue
+            if metrics.enabled:
+                metrics.observe("payload_queue_wait", started - received)
+                metrics.observe("decode", time.perf_counter() - started)
+            if self.reorder is not None:
+                self.reorder.push(samples, received)
+                continue
+            for sample in samples:
+                started = time.perf_counter()
+                if not safe_update(self, sample):
+                    continue
+                if metrics.enabled:
+                    metrics.observe("receive_to_filter", started - received)
+                    metrics.observe("filter", time.perf_counter() - started)
+                    # only meaningful when the publisher stamps samples with its epoch time
+                    if sample["timestamp"] > 1e9:
+                        metrics.observe("transport", time.time() - sample["timestamp"])
+            self.samples_filtered += len(samples)
+            self.latest_received = received
+        if self.reorder is not None:
+            self.release()
+        return bool(self.payloads)
+
+    def _filter_batch(self) -> bool:
+        metrics = self.metrics
+        pending = [self.payloads.popleft() for _ in range(min(self.budget, len(self.payloads)))]
+        if not pending:
+            return False
+        started = time.perf_counter()
+        samples, errors = decode_burst(self.decode, [payload for _, payload in pending])
+        self.decode_errors += errors
+        decoded = time.perf_counter()
+        if self.reorder is not None:
+            if len(samples):
+                self.reorder.push(samples, pending[-1][0])
+            samples = self.release()
+        elif len(samples):
+            if safe_update(self, samples):
+                self.samples_filtered += len(samples)
+                self.latest_received = pending[-1][0]
+            else:
+                samples = samples[:0]
+        if metrics.enabled:
+            for received, _ in pending:
+                metrics.observe("payload_queue_wait", started - received)
+            metrics.observe("decode", (decoded - started) / len(pending))
+            if len(samples):
+                metrics.observe("receive_to_filter", decoded - pending[0][0])
+                metrics.observe("filter", (time.perf_counter() - decoded) / len(samples))
+                if samples[-1]["timestamp"] > 1e9:
+                    metrics.observe("transport", time.time() - samples[-1]["timestamp"])
+        return bool(self.payloads)
+
+    def release(self) -> np.ndarray:
+        """ Filter what the jitter buffer lets go of, returns those samples """
+        samples, dt, received = self.reorder.pop(time.perf_counter())
+        if not len(samples):
+            return samples
+        if self.batch:
+            if not safe_update(self, samples, dt):
+                return samples[:0]
+        else:
+            for sample, sample_dt in zip(samples, dt.tolist()):
+                safe_update(self, sample, sample_dt)
+        self.samples_filtered += len(samples)
+        self.latest_received = received
+        return samples
+
+    def _release_interval(self) -> float:
+        timeout = self.reorder.timeout(time.perf_counter())
+        if timeout is None:
+            # nothing held, the filter task releases whatever comes in next
+            return max(self.reorder.latency, 0.01)
+        return timeout
+
+    def stats(self) -> dict:
+        stats = {
+            "payloads": {
+                "depth": len(self.payloads),
+                "put": self.put_count,
+                "dropped": self.dropped,
+            },
+            "samples_filtered": self.samples_filtered,
+            "decode_errors": self.decode_errors,
+            "update_errors": self.update_errors,
+        }
+        if self.reorder is not None:
+            stats["reorder"] = self.reorder.stats()
+        return stats
+
+
+class MqttSocketBridge:
+    """
+    Drives a paho client from the event loop instead of loop_start's thread
+
+    paho reports its socket through the on_socket_* callbacks, reads and
+    writes are done by loop callbacks when the socket is ready, and
+    keepalive pings by a small coroutine calling loop_misc once a second.
+    A read also drains whatever is already buffered above the socket.
+    Must be created before client.connect.
+    """
+
+    def __init__(self, client: mqtt.Client, loop: asyncio.AbstractEventLoop):
+        self.client = client
+        self.loop = loop
+        self._misc = None
+        client.on_socket_open = self.on_socket_open
+        client.on_socket_close = self.on_socket_close
+        client.on_socket_register_write = self.on_socket_register_write
+        client.on_socket_unregister_write = self.on_socket_unregister_write
+
+    def on_socket_open(self, client, userdata, sock):
+        self.loop.add_reader(sock, self.on_readable, sock)
+        self._misc = self.loop.create_task(self.misc_loop())
+
+    def on_socket_close(self, client, userdata, sock):
+        self.loop.remove_reader(sock)
+        if self._misc is not None:
+            self._misc.cancel()
+            self._misc = None
+
+    def on_readable(self, sock):
+        rc = self.client.loop_read()
+        # bytes already pulled off the socket, e.g. the rest of a TLS record,
+        # don't make it readable again, read them before waiting on it,
+        # plain sockets have no such buffer
+        pending = getattr(sock, "pending", None)
+        while pending is not None and rc == mqtt.MQTT_ERR_SUCCESS and self.client.socket() is sock and pending():
+            rc = self.client.loop_read()
+
+    def on_socket_register_write(self, client, userdata, sock):
+        self.loop.add_writer(sock, client.loop_write)
+
+    def on_socket_unregister_write(self, client, userdata, sock):
+        self.loop.remove_writer(sock)
+
+    async def misc_loop(self):
+        while self.client.loop_misc() == mqtt.MQTT_ERR_SUCCESS:
+            try:
+                await asyncio.sleep(1)
+            except asyncio.CancelledError:
+                break
+
+
+def run(main):
+    """ asyncio.run, on a selector loop on windows where the default loop has no add_reader """
+    if sys.platform == "win32":
+        loop = asyncio.SelectorEventLoop()
+        try:
+            return loop.run_until_complete(main)
+        finally:
+            loop.close()
+    return asyncio.run(main)
@@ -0,0 +1,166 @@
+"""
+Euler angles of whole orientation trajectories
+
+Every function takes one [w, x, y, z] quaternion (4,) or a trajectory
+(N, 4) and works on all rows in a single numpy pass, so converting a
+recording costs about as much as converting a handful of samples one at
+a time. Angles are in radians unless stated otherwise.
+
+Export a processed session as csv with
+
+    python attitude.py logs/log.json session.csv
+    python attitude.py data/acc.csv data/ang_vel.csv data/mag.csv session.csv
+"""
+import math
+
+import numpy as np
+
+EXPORT_COLUMNS = (
+    "timestamp",
+    "qw", "qx", "qy", "qz",
+    "roll", "pitch", "yaw",
+    "roll_rel", "pitch_rel", "yaw_rel",
+    "roll_rate", "pitch_rate", "yaw_rate",
+)
+
+
+def rpy(Q, degrees: bool = False) -> np.ndarray:
+    """
+    Roll, pitch, yaw (..., 3) of quaternions (..., 4)
+
+    Same angles as ahrs' q2rpy and QuaternionArray.to_angles, except that
+    pitch is clipped to +-90 degrees where rounding puts the arcsin input
+    just outside [-1, 1] instead of turning into nan.
+    """
+    Q = np.asarray(Q, dtype=np.float64)
+    if Q.ndim == 1:
+        # a single orientation, e.g. once per frame, numpy's per call overhead would dwarf the arithmetic
+        w, x, y, z = Q.tolist()
+        angles = [
+            math.atan2(2.0 * (w * x + y * z), 1.0 - 2.0 * (x * x + y * y)),
+            math.asin(min(1.0, max(-1.0, 2.0 * (w * y - z * x)))),
+            math.atan2(2.0 * (w * z + x * y), 1.0 - 2.0 * (y * y + z * z)),
+        ]
+        return np.degrees(angles) if degrees else np.array(angles)
+    w, x, y, z = np.moveaxis(Q, -1, 0)
+    angles = np.empty(Q.shape[:-1] + (3,))
+    np.arctan2(2.0 * (w * x + y * z), 1.0 - 2.0 * (x * x + y * y), out=angles[..., 0])
+    np.arcsin(np.clip(2.0 * (w * y - z * x), -1.0, 1.0), out=angles[..., 1])
+    np.arctan2(2.0 * (w * z + x * y), 1.0 - 2.0 * (y * y + z * z), out=angles[..., 2])
+    if degrees:
+        np.degrees(angles, out=angles)
+    return angles
+
+
+def ypr(Q, yaw_offset: float = 0.0) -> np.ndarray:
+    """ Yaw, pitch, roll (..., 3) in degrees, the order the viewers show them in, with `yaw_offset` degrees added to yaw """
+    angles = rpy(Q, degrees=True)[..., ::-1]
+    angles[..., 0] += yaw_offset
+    return angles
+
+
+def wrap(angles) -> np.ndarray:
+    """ Angles in radians wrapped to [-pi, pi) """
+    return (np.asarray(angles) + np.pi) % (2.0 * np.pi) - np.pi
+
+
+def relative(angles, reference) -> np.ndarray:
+    """
+    Angles minus the angles of a reference orientation, e.g. the first estimate
+
+    Wrapped, so a yaw crossing +-180 degrees is a small change rather than a
+    jump of a full turn.
+    """
+    return wrap(np.asarray(angles) - np.asarray(reference))
+
+
+def rates(angles: np.ndarray, timestamp: np.ndarray) -> np.ndarray:
+    """
+    Rate of change (N, 3) of an (N, 3) angle trajectory, per second of `timestamp`
+
+    The angles are unwrapped first so crossing +-180 degrees doesn't show up
+    as a spike. Central differences inside, one sided at both ends. Only
+    samples newer than every one before them are differentiated, a repeated
+    or earlier timestamp would divide by zero or a negative time, those
+    samples get the rate of the last one that was. Zero rates when fewer
+    than two timestamps are distinct.
+    """
+    angles = np.asarray(angles, dtype=np.float64)
+    timestamp = np.asarray(timestamp, dtype=np.float64)
+    out = np.zeros_like(angles)
+    if len(timestamp) == 0:
+        return out
+    newer = np.empty(len(timestamp), dtype=bool)
+    newer[0] = True
+    newer[1:] = timestamp[1:] > np.maximum.accumulate(timestamp)[:-1]
+    if np.count_nonzero(newer) < 2:
+        return out
+    kept = np.gradient(np.unwrap(angles[newer], axis=0), timestamp[newer], axis=0)
+    # index into the kept samples of the last one at or before each sample
+    return kept[np.cumsum(newer) - 1]
+
+
+def trajectory(timestamp: np.ndarray, Q: np.ndarray, reference: int = 0, degrees: bool = False) -> np.ndarray:
+    """
+    Table (N, len(EXPORT_COLUMNS)) of a processed session
+
+    reference: index of the estimate the relative angles are measured from
+    """
+    angles = rpy(Q)
+    table = np.column_stack(
+        [timestamp, Q, angles, relative(angles, angles[reference]), rates(angles, timestamp)]
+    )
+    if degrees:
+        np.degrees(table[:, 5:], out=table[:, 5:])
+    return table
+
+
+def export_csv(path: str, timestamp: np.ndarray, Q: np.ndarray, reference: int = 0, degrees: bool = False) -> None:
+    np.savetxt(
+        path,
+        trajectory(timestamp, Q, reference, degrees),
+        delimiter=",",
+        header=",".join(EXPORT_COLUMNS),
+        comments="",
+        # microseconds of epoch timestamps need more than 9 significant digits
+        fmt=["%.6f"] + ["%.9g"] * (len(EXPORT_COLUMNS) - 1),
+    )
+
+
+def load_session(paths, frequency: float = 20.0):
+    """ timestamp (N,) and estimates (N, 4) of a json log, a columnar log or the three csv exports """
+    from imu_log import ColumnarLog, COLUMNAR_SUFFIX
+    from orientation_cache import csv_orientations, json_log_orientations
+
+    if len(paths) == 3:
+        estimates = csv_orientations(*paths)
+    elif paths[0].endswith(COLUMNAR_SUFFIX):
+        log = ColumnarLog(paths[0])
+        return log.timestamp, log.quat
+    else:
+        estimates = json_log_orientations(paths[0], frequency)
+    return estimates["timestamp"], estimates["quat"]
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Export the orientation, Euler angles and angle rates of a session as csv")
+    parser.add_argument("src", nargs="+", help="log.json, log.imucol, or acc.csv ang_vel.csv mag.csv")
+    parser.add_argument("dst", help="output csv")
+    parser.add_argument("--reference", type=int, default=0, help="index of the estimate relative angles are measured from")
+    parser.add_argument("--degrees", action="store_true", help="angles in degrees instead of radians")
+    parser.add_argument("--frequency", type=float, default=20.0, help="sample rate of json logs")
+    args = parser.parse_args()
+
+    if len(args.src) not in (1, 3):
+        parser.error("expected one log or three csv files")
+    timestamp, Q = load_session(args.src, args.frequency)
+    if not -len(Q) <= args.reference < len(Q):
+        parser.error(f"--reference {args.reference} is outside the session's {len(Q)} estimates")
+    export_csv(args.dst, timestamp, Q, args.reference, args.degrees)
+    print(f"Wrote {len(Q)} rows to {args.dst}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,267 @@
+"""
+Benchmarks for the receive -> filter -> render hot path
+
+Drives the real OrientationViewer, codec and opengl code with a synthetic
+IMU stream, without a broker or a display, and prints throughput and
+latency percentiles as json, e.g.
+
+    python benchmark.py --samples 5000 --output bench_output.txt
+"""
+import argparse
+import importlib.util
+import json
+import os
+import platform
+import sys
+import time
+
+# opengl.draw is timed on an offscreen EGL context when there is no display,
+# PyOpenGL picks its platform on first import so this has to come first
+if "PYOPENGL_PLATFORM" not in os.environ and not os.environ.get("DISPLAY"):
+    os.environ["PYOPENGL_PLATFORM"] = "egl"
+# pygame prints a banner on import, keep stdout clean for the json report
+os.environ.setdefault("PYGAME_HIDE_SUPPORT_PROMPT", "1")
+
+import numpy as np
+
+import imu_codec
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def load_viewer_module():
+    """ visualise-realtime.py is not importable by name because of the dash """
+    spec = importlib.util.spec_from_file_location("visualise_realtime", os.path.join(HERE, "visualise-realtime.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def synthetic_samples(count: int, rate: float = 100.0, seed: int = 0) -> np.ndarray:
+    """
+    A phone turning about the vertical axis while rocking side to side
+
+    acc and mag are the gravity and earth field vectors seen in the body
+    frame, gyro is the matching angular rate, all with a little noise
+    """
+    rng = np.random.default_rng(seed)
+    t = np.arange(count) / rate
+    yaw, yaw_rate = 0.5 * t, np.full(count, 0.5)
+    roll, roll_rate = 0.3 * np.sin(t), 0.3 * np.cos(t)
+
+    cy, sy, cr, sr = np.cos(yaw), np.sin(yaw), np.cos(roll), np.sin(roll)
+    # rows of R = Rz(yaw) Rx(roll), body vectors are R^T @ world
+    rotation = np.stack(
+        [
+            np.stack([cy, -sy * cr, sy * sr], axis=-1),
+            np.stack([sy, cy * cr, -cy * sr], axis=-1),
+            np.stack([np.zeros(count), sr, cr], axis=-1),
+        ],
+        axis=1,
+    )
+    gravity = np.array([0.0, 0.0, 9.81])
+    field = np.array([20.0, 0.0, -40.0])
+
+    samples = imu_codec.empty_samples(count)
+    samples["timestamp"] = t
+    samples["acc"] = np.einsum("nji,j->ni", rotation, gravity) + rng.normal(0, 0.05, (count, 3))
+    samples["mag"] = np.einsum("nji,j->ni", rotation, field) + rng.normal(0, 0.5, (count, 3))
+    samples["gyro"] = np.stack([roll_rate, np.zeros(count), yaw_rate], axis=-1) + rng.normal(0, 0.01, (count, 3))
+    return samples
+
+
+def summarise(durations_ns) -> dict:
+    durations_us = np.asarray(durations_ns, dtype=np.float64) / 1e3
+    total_s = durations_us.sum() / 1e6
+    return {
+        "count": len(durations_us),
+        "throughput_per_s": len(durations_us) / total_s if total_s else None,
+        "mean_us": float(durations_us.mean()),
+        "p50_us": float(np.percentile(durations_us, 50)),
+        "p99_us": float(np.percentile(durations_us, 99)),
+    }
+
+
+def time_each(fn, items) -> dict:
+    durations = np.empty(len(items), dtype=np.int64)
+    clock = time.perf_counter_ns
+    for i, item in enumerate(items):
+        start = clock()
+        fn(item)
+        durations[i] = clock() - start
+    return summarise(durations)
+
+
+def bench_decode(samples) -> dict:
+    json_payloads = [imu_codec.encode_json(samples[i : i + 1]) for i in range(len(samples))]
+    binary_payloads = [imu_codec.encode(samples[i : i + 1]) for i in range(len(samples))]
+    batched = imu_codec.encode(samples[:64])
+    return {
+        "decode_json": time_each(imu_codec.decode, json_payloads),
+        "decode_binary": time_each(imu_codec.decode, binary_payloads),
+        # one payload carrying 64 samples, per payload
+        "decode_binary_x64": time_each(imu_codec.decode, [batched] * (len(samples) // 64 or 1)),
+    }
+
+
+def bench_update_estimate(viewer_module, samples) -> dict:
+    viewer = viewer_module.OrientationViewer("localhost", 0)
+    # the first sample initialises the filter, keep it out of the numbers
+    viewer.update_estimate(samples[0])
+    return {"update_estimate": time_each(viewer.update_estimate, samples[1:])}
+
+
+def bench_filters(samples) -> dict:
+    """ Cost per sample of every orientation filter, run as one batch """
+    from orientation_filters import FILTER_NAMES, make_filter
+
+    results = {}
+    for name in FILTER_NAMES:
+        orientation_filter = make_filter(name, frequency=20, frame="ENU")
+        orientation_filter.reset(samples[0]["acc"], samples[0]["mag"])
+        orientation_filter.update_many(samples["gyro"][1:], samples["acc"][1:], samples["mag"][1:])
+        results[name] = {"cost_us": orientation_filter.cost_us}
+    return {"filters": results}
+
+
+def bench_euler(quaternions) -> dict:
+    from ahrs.common.orientation import q2rpy
+
+    import attitude
+    import opengl
+
+    started = time.perf_counter()
+    attitude.rpy(quaternions)
+    bulk = time.perf_counter() - started
+    return {
+        "q2rpy": time_each(q2rpy, quaternions),
+        "quat_to_ypr": time_each(opengl.quat_to_ypr, quaternions),
+        # the whole trajectory in one call, per sample
+        "rpy_bulk_us": bulk / len(quaternions) * 1e6,
+    }
+
+
+def bench_pipeline(viewer_module, samples, per_payload: int = 1, batch: bool = True) -> dict:
+    """ Submit payloads as the network thread would and wait for the filter to catch up """
+    from pipeline import BLOCK
+
+    viewer = viewer_module.OrientationViewer("localhost", 0, overflow=BLOCK, batch=batch)
+    payloads = [imu_codec.encode(samples[i : i + per_payload]) for i in range(0, len(samples), per_payload)]
+    viewer.pipeline.start()
+    start = time.perf_counter()
+    for payload in payloads:
+        viewer.pipeline.submit(payload)
+    while viewer.Q.count < len(samples):
+        time.sleep(0.001)
+    elapsed = time.perf_counter() - start
+    viewer.pipeline.stop()
+    return {
+        f"pipeline_x{per_payload}" + ("" if batch else "_unbatched"): {
+            "count": len(samples),
+            "throughput_per_s": len(samples) / elapsed,
+            "stats": viewer.pipeline.stats(),
+        }
+    }
+
+
+def make_offscreen_context(width: int, height: int) -> bool:
+    """ Create and bind a surfaceless EGL pbuffer context, False if that is not possible """
+    import ctypes
+
+    try:
+        from OpenGL import EGL
+    except ImportError:
+        return False
+    try:
+        display = EGL.eglGetDisplay(EGL.EGL_DEFAULT_DISPLAY)
+        major, minor = EGL.EGLint(), EGL.EGLint()
+        EGL.eglInitialize(display, ctypes.pointer(major), ctypes.pointer(minor))
+        attributes = (EGL.EGLint * 9)(
+            EGL.EGL_SURFACE_TYPE, EGL.EGL_PBUFFER_BIT,
+            EGL.EGL_DEPTH_SIZE, 24,
+            EGL.EGL_RENDERABLE_TYPE, EGL.EGL_OPENGL_BIT,
+            EGL.EGL_RED_SIZE, 8,
+            EGL.EGL_NONE,
+        )
+        config, found = EGL.EGLConfig(), EGL.EGLint()
+        EGL.eglChooseConfig(display, attributes, ctypes.pointer(config), 1, ctypes.pointer(found))
+        if not found.value:
+            return False
+        size = (EGL.EGLint * 5)(EGL.EGL_WIDTH, width, EGL.EGL_HEIGHT, height, EGL.EGL_NONE)
+        surface = EGL.eglCreatePbufferSurface(display, config, size)
+        EGL.eglBindAPI(EGL.EGL_OPENGL_API)
+        context = EGL.eglCreateContext(display, config, EGL.EGL_NO_CONTEXT, None)
+        return bool(EGL.eglMakeCurrent(display, surface, surface, context))
+    except Exception as e:
+        print(f"No offscreen GL context: {e}", file=sys.stderr)
+        return False
+
+
+def bench_draw(quaternions) -> dict:
+    if os.environ.get("PYOPENGL_PLATFORM") != "egl" or not make_offscreen_context(800, 600):
+        return {"draw": {"skipped": "no offscreen GL context"}}
+
+    import pygame
+    from OpenGL.GL import glFinish
+
+    import opengl
+
+    pygame.font.init()
+    opengl.resizewin(800, 600)
+    opengl.initWindow()
+    # the first frame compiles the display lists
+    opengl.draw(quaternions[0])
+
+    def frame(q):
+        opengl.draw(q)
+        glFinish()
+
+    return {"draw": time_each(frame, quaternions)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the receive -> filter -> render hot path")
+    parser.add_argument("--samples", type=int, default=2000, help="samples in the synthetic stream")
+    parser.add_argument("--frames", type=int, default=300, help="frames to draw")
+    parser.add_argument("--output", help="write the json report here instead of stdout")
+    parser.add_argument("--no-draw", action="store_true", help="skip the opengl.draw benchmark")
+    args = parser.parse_args()
+
+    viewer_module = load_viewer_module()
+    samples = synthetic_samples(args.samples)
+
+    results = {}
+    results.update(bench_decode(samples))
+    results.update(bench_update_estimate(viewer_module, samples))
+    results.update(bench_filters(samples))
+
+    viewer = viewer_module.OrientationViewer("localhost", 0, history=args.samples)
+    for sample in samples:
+        viewer.update_estimate(sample)
+    quaternions = np.array(viewer.Q.window(args.samples))
+    results.update(bench_euler(quaternions))
+
+    for batch in (True, False):
+        results.update(bench_pipeline(viewer_module, samples, per_payload=1, batch=batch))
+        results.update(bench_pipeline(viewer_module, samples, per_payload=16, batch=batch))
+
+    if not args.no_draw:
+        results.update(bench_draw(quaternions[: args.frames]))
+
+    report = {
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "machine": platform.machine(),
+        "samples": args.samples,
+        "results": results,
+    }
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,7 @@
 import bpy
 import math
 import socket
-import json
+import time
 from os import link
 from mathutils import Euler
 
@@ -15,14 +15,43 @@ from datetime import datetime
 
 from ahrs.filters import EKF
 from ahrs.common.quaternion import QuaternionArray
-from ahrs.common.orientation import ecompass, q2rpy, acc2q
+from ahrs.common.orientation import ecompass, acc2q
+
+import imu_codec
+from attitude import rpy, relative
+from ring_buffer import RingBuffer
+from jitter_buffer import JitterBuffer
+from orientation_filters import make_filter
+from pipeline import Pipeline, DROP_OLDEST
+from recorder import SessionRecorder
+from sliders import SliderChannels
+from shared_state import SharedStateReader
+from metrics import NULL_METRICS
 
 imu_topic = "stream/imu"
 jaw_angle_topic = "stream/jaw_angle"
 link_angle_topic = "stream/link_angle"
 
+# name of the shared memory block a local `visualise-realtime.py --share`
+# publishes to, read instead of subscribing and filtering here when set
+SHARED_STATE = None
+
 class OrientationViewer:
-    def __init__(self, broker_host: str, broker_port: int):
+    def __init__(
+        self,
+        broker_host: str,
+        broker_port: int,
+        history: int = 1024,
+        queue_size: int = 256,
+        overflow: str = DROP_OLDEST,
+        rate: float = 30.0,
+        recorder: SessionRecorder = None,
+        metrics=NULL_METRICS,
+        batch: bool = True,
+        filter_name: str = "ekf",
+        jitter_latency: float = 0.03,
+        shared: str = None,
+    ):
         # Get armature:
         self.arm1 = bpy.data.objects["Armature.001"]
         # Select as active and set mode:
@@ -45,13 +74,56 @@ class OrientationViewer:
         self.broker_host = broker_host
         self.broker_port = broker_port
         self.is_connected = False
-        # orietation estimates
-        self.Q = []
-        #? initialise filter object on arrival of first measurement
+        # orietation estimates, only the last `history` are kept
+        self.Q = RingBuffer(history, width=4)
+        # orientation filter, its state is initialised on arrival of first measurement
         # TODO set to frequency of phone sensors
-        # self.ekf = EKF(frequency=10)
+        self.filter = make_filter(filter_name, frequency=20, frame="ENU")
+        metrics.gauge("filter_cost_us", lambda: self.filter.cost_us)
+        # reorder samples by timestamp and filter them with their real dt, None to keep arrival order
+        self.reorder = None
+        if jitter_latency is not None:
+            self.reorder = JitterBuffer(jitter_latency, nominal_dt=self.filter.Dt, metrics=metrics)
+        # decode and filter off the network thread, through bounded queues,
+        # a burst between two timer ticks is filtered as one batch
+        self.pipeline = Pipeline(
+            imu_codec.decode_many if batch else imu_codec.decode,
+            self.update_estimates if batch else self.update_estimate,
+            payload_queue_size=queue_size,
+            sample_queue_size=queue_size,
+            policy=overflow,
+            metrics=metrics,
+            batch=batch,
+            reorder=self.reorder,
+        )
+        # per stage latencies, a no-op unless a Metrics object is passed in
+        self.metrics = metrics
+        # newest slider payloads, decoded and applied to the pose by the timer
+        self.sliders = SliderChannels({link_angle_topic: "link_angle", jaw_angle_topic: "jaw_angle"})
+        metrics.gauge("slider_values_dropped", lambda: self.sliders.dropped)
+        # pose updates run on a blender timer `rate` times a second, about the redraw rate
+        self.interval = 1.0 / rate
+        # timers are matched by identity, keep one bound method around
+        self._timer = self.update_pose
+        self._applied_count = 0
+        # optional background recording of every received message
+        self.recorder = recorder
+        # name of a shared memory block to read estimates and sliders from instead
+        self.shared = shared
+        self.reader = None
+        self._shared_count = 0
+        self._shared_sliders = {}
 
     def connect_to_broker(self):
+        if self.shared is not None:
+            # another process ingests and filters, only its newest state is read
+            self.reader = SharedStateReader(self.shared)
+            print(f"Reading the orientation from shared memory block {self.shared}")
+            self.start()
+            return
+        self.pipeline.start()
+        if self.recorder is not None:
+            self.recorder.start()
         self.client.connect(self.broker_host, self.broker_port)
         # runs a thread in the background that calls loop()
         # call loop_stop() to stop the thread
@@ -65,9 +137,19 @@ class OrientationViewer:
         print(mid)
 
     def disconnect_from_broker(self):
-        if self.is_connected:
+        self.stop()
+        if self.reader is not None:
+            self.reader.close()
+            self.reader = None
+        elif self.is_connected:
             self.client.loop_stop()
+            self.pipeline.stop()
             self.is_connected = False
+            print(f"Pipeline stats: {self.pipeline.stats()}")
+            print(f"Slider stats: {self.sliders.stats()}")
+            if self.recorder is not None:
+                # flushes everything still pending to disk
+                self.recorder.close()
             print("Disconnected from broker")
             # print(self.Q)
         else:
@@ -81,66 +163,114 @@ class OrientationViewer:
             print(f"Connect returned result code {str(rc)}")
 
     def on_message(self, client, userdata, msg):
-        decoded_msg = msg.payload.decode("utf-8")
-        # print(msg.topic, decoded_msg)
-        if msg.topic == link_angle_topic:
-            link_angle = json.loads(decoded_msg)["link_angle"]
-            self.limb3.rotation_euler = Euler((0, 0, -link_angle), "XYZ")
-            print(link_angle)
-        elif msg.topic == jaw_angle_topic:
-            jaw_angle = json.loads(decoded_msg)["jaw_angle"]
-            self.jawBone.rotation_euler = Euler((0, 0, -(jaw_angle / 10)), "XYZ")
-            print(jaw_angle)
-        elif msg.topic == imu_topic:
-            sensor_data = json.loads(decoded_msg)
-            q.put(sensor_data)
-            self.update_estimate(sensor_data)
-
-    def update_estimate(self, measurement):
-        acc, gyro, mag = measurement["acc"], measurement["gyro"], measurement["mag"]
-
-        acc = np.array([acc["x"], acc["y"], acc["z"]])
-        gyro = np.array([gyro["x"], gyro["y"], gyro["z"]])
-        mag = np.array([mag["x"], mag["y"], mag["z"]])
+        # print(msg.topic, msg.payload)
+        if self.recorder is not None:
+            self.recorder.record(msg.topic, msg.payload)
+        if msg.topic == imu_topic:
+            # decoded and filtered by the pipeline workers
+            self.pipeline.submit(msg.payload, time.perf_counter())
+        else:
+            # bpy is not thread safe, the newest slider payload is kept for the timer
+            self.sliders.put(msg.topic, msg.payload)
+
+    def update_estimate(self, sample, dt: float = None):
+        # sample is a record of imu_codec.SAMPLE_DTYPE, fields are views into the payload
+        acc, gyro, mag = sample["acc"], sample["gyro"], sample["mag"]
 
         if len(self.Q) == 0:
             # this is the first measurement
-            # initialising the filter expects arguments as N x 3 array
-            acc = np.array([acc])
-            gyro = np.array([gyro])
-            mag = np.array([mag])
-
-              # initialise filter object on first measure
-            self.ekf = EKF(gyr=gyro, acc=acc, mag=mag, frequency=20, frame="ENU")
-            estimate = self.ekf.Q[0]
+            # initialise filter state on first measure
+            estimate = self.filter.reset(acc, mag)
 
             # store the first measurement
-            self.iRef = q2rpy(estimate)
+            self.iRef = rpy(estimate)
 
         else:
             # run the update step of the kalman filter
-            # using the apriori estimate and current sensor measurements
-            estimate = self.ekf.update(q=self.Q[-1], gyr=gyro, acc=acc, mag=mag)
+            # using the apriori estimate (kept by the filter) and current sensor measurements
+            estimate = self.filter.update(gyro, acc, mag, dt)
 
         # store it the orientation estimate for the next timestep
         self.Q.append(estimate)
 
-    def start(self):
-        # When we get message from broker, update orientation
-        while True:
+    def update_estimates(self, samples, dt=None):
+        """ Filter a whole burst in one loop, the history gets a single bulk append """
+        if len(self.Q) == 0:
+            self.update_estimate(samples[0])
+            samples = samples[1:]
+            dt = None if dt is None else dt[1:]
+        if len(samples):
+            self.Q.extend(self.filter.update_many(samples["gyro"], samples["acc"], samples["mag"], dt))
+
+    def read_shared(self) -> dict:
+        """ Append the newest shared estimate to Q if it changed, returns the sliders that changed """
+        try:
+            state = self.reader.read()
+        except TimeoutError as e:
+            # raising would unregister the timer, try again on the next tick
+            print(e)
+            return {}
+        count = int(state["count"])
+        if count != self._shared_count:
+            self._shared_count = count
             if len(self.Q) == 0:
-                continue
-            gData = q2rpy(self.Q[-1]) - self.iRef
-            print(gData)
+                self.iRef = rpy(state["quat"])
+            self.Q.append(state["quat"])
+        sliders = {}
+        for topic, key in self.sliders.keys.items():
+            value = float(state[key])
+            # nan until the first value arrives
+            if not math.isnan(value) and value != self._shared_sliders.get(topic):
+                self._shared_sliders[topic] = sliders[topic] = value
+        return sliders
+
+    def start(self):
+        # returns right away, blender calls update_pose from its main loop
+        if not bpy.app.timers.is_registered(self._timer):
+            bpy.app.timers.register(self._timer, first_interval=self.interval, persistent=True)
+
+    def stop(self):
+        if bpy.app.timers.is_registered(self._timer):
+            bpy.app.timers.unregister(self._timer)
+
+    def update_pose(self):
+        started = time.perf_counter()
+        # apply only the newest values, everything in between is never seen
+        sliders = self.sliders.take() if self.reader is None else self.read_shared()
+        changed = bool(sliders)
+        if link_angle_topic in sliders:
+            self.limb3.rotation_euler = Euler((0, 0, -sliders[link_angle_topic]), "XYZ")
+        if jaw_angle_topic in sliders:
+            self.jawBone.rotation_euler = Euler((0, 0, -(sliders[jaw_angle_topic] / 10)), "XYZ")
+
+        # Q.count only changes when a new estimate was published
+        count = self.Q.count
+        if count != self._applied_count:
+            self._applied_count = count
+            gData = relative(rpy(self.Q[-1]), self.iRef)
             # 0 up/down, 2 left/right
             self.limb2.rotation_euler = Euler((-gData[2], 0, gData[0]), "XYZ")
-            bpy.ops.wm.redraw_timer(type="DRAW_WIN_SWAP", iterations=1)
+            changed = True
+
+        if changed:
+            for window in bpy.context.window_manager.windows:
+                for area in window.screen.areas:
+                    if area.type == "VIEW_3D":
+                        area.tag_redraw()
+            if self.metrics.enabled:
+                now = time.perf_counter()
+                self.metrics.observe("pose", now - started)
+                # the redraw itself happens after this returns
+                if self.pipeline.latest_received is not None:
+                    self.metrics.observe("receive_to_pose", now - self.pipeline.latest_received)
+        # seconds until blender calls this again
+        return self.interval
 
 
 def main():
     myIP = socket.gethostbyname_ex(socket.gethostname())[-1][-1]
     PORT = 8883
-    viewer = OrientationViewer(myIP, PORT)
+    viewer = OrientationViewer(myIP, PORT, shared=SHARED_STATE)
     viewer.connect_to_broker()
 
 
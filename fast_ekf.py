@@ -0,0 +1,232 @@
+"""
+Quaternion EKF with preallocated state and scratch buffers
+
+Computes the same estimates as ahrs.filters.EKF for a 4 state quaternion
+and a 6 (acc + mag) or 3 (acc only) value measurement. The state vector,
+covariance, Jacobians and intermediate products are allocated once and
+updated in place, with the small per sample terms done on Python floats.
+
+Check it against ahrs on the recorded streams with
+
+    python fast_ekf.py data/acc.csv data/ang_vel.csv data/mag.csv
+"""
+import math
+
+import numpy as np
+from ahrs.common.orientation import acc2q, ecompass
+from ahrs.filters import EKF
+
+from orientation_filters import OrientationFilter
+
+
+def _floats(values):
+    if isinstance(values, list):
+        return values
+    return values.tolist() if isinstance(values, np.ndarray) else [float(v) for v in values]
+
+
+class QuaternionEKF(OrientationFilter):
+    """
+    Drop in for the per sample use of ahrs.filters.EKF
+
+    `reset` sets the initial orientation from the first sample the same
+    way EKF does, `update` then runs one predict/correct step on the
+    filter's own state and returns it. The returned array is reused by
+    the next update, copy it to keep it (RingBuffer.append copies).
+    """
+
+    name = "ekf"
+
+    def __init__(self, frequency: float = 100.0, frame: str = "NED", **kwargs):
+        # ahrs' EKF is written for both frames, its estimates need no rotation
+        self.native_frame = frame
+        super().__init__(frequency, frame)
+        # let ahrs validate the arguments and pick the reference vectors and noises
+        reference = EKF(frequency=frequency, frame=frame, **kwargs)
+        self.Dt = reference.Dt
+        self.g_noise, self.a_noise, self.m_noise = (float(n) for n in reference.noises)
+        self.a_ref = _floats(reference.a_ref)
+        self.m_ref = _floats(reference.m_ref)
+        self._P0 = np.array(reference.P, dtype=np.float64)
+
+        self.P = self._P0.copy()
+        self._identity = np.identity(4)
+
+        # scratch, one set for acc + mag and one for acc only
+        self._F = np.empty((4, 4))
+        self._W = np.empty((4, 3))
+        self._Qt = np.empty((4, 4))
+        self._Pt = np.empty((4, 4))
+        self._FP = np.empty((4, 4))
+        self._KH = np.empty((4, 4))
+        self._Kv = np.empty(4)
+        self._buffers = {rows: self._measurement_buffers(rows) for rows in (3, 6)}
+
+    def _measurement_buffers(self, rows: int) -> dict:
+        S = np.empty((rows, rows))
+        return {
+            "H": np.empty((rows, 4)),
+            "HP": np.empty((rows, 4)),
+            "PHt": np.empty((4, rows)),
+            "S": S,
+            # writable view of the diagonal of S, to add R in place
+            "S_diag": S.reshape(-1)[:: rows + 1],
+            "R": np.array([self.a_noise] * 3 + [self.m_noise] * (rows - 3)),
+            "K": np.empty((4, rows)),
+            "v": np.empty(rows),
+        }
+
+    def _reset(self, acc, mag=None) -> np.ndarray:
+        """ Initial orientation from one accelerometer (and magnetometer) sample """
+        if mag is not None:
+            q = ecompass(np.asarray(acc, dtype=float), np.asarray(mag, dtype=float), frame=self.frame, representation="quaternion")
+        else:
+            q = acc2q(np.asarray(acc, dtype=float))
+        self.q[:] = q
+        self.q /= np.linalg.norm(self.q)
+        self.P[:] = self._P0
+        return self.q
+
+    def _update(self, gyr, acc, mag=None, dt: float = None) -> np.ndarray:
+        dt = self.Dt if dt is None else dt
+        ax, ay, az = _floats(acc)
+        a_norm = math.sqrt(ax * ax + ay * ay + az * az)
+        if a_norm == 0:
+            return self.q
+        z = [ax / a_norm, ay / a_norm, az / a_norm]
+        if mag is not None:
+            mx, my, mz = _floats(mag)
+            m_norm = math.sqrt(mx * mx + my * my + mz * mz)
+            if m_norm == 0:
+                raise ValueError("Invalid geomagnetic field. Its magnitude must be greater than zero.")
+            z += [mx / m_norm, my / m_norm, mz / m_norm]
+        buffers = self._buffers[len(z)]
+
+        gx, gy, gz = _floats(gyr)
+        qw, qx, qy, qz = self.q.tolist()
+        h = 0.5 * dt
+
+        # ----- prediction -----
+        # F = I + dt/2 Omega(gyr), q_t = F q
+        F = self._F
+        F[:] = (
+            (1.0, -h * gx, -h * gy, -h * gz),
+            (h * gx, 1.0, h * gz, -h * gy),
+            (h * gy, -h * gz, 1.0, h * gx),
+            (h * gz, h * gy, -h * gx, 1.0),
+        )
+        tw = qw - h * gx * qx - h * gy * qy - h * gz * qz
+        tx = h * gx * qw + qx + h * gz * qy - h * gy * qz
+        ty = h * gy * qw - h * gz * qx + qy + h * gx * qz
+        tz = h * gz * qw + h * gy * qx - h * gx * qy + qz
+
+        # process noise g_noise W W^T with W = df/dgyr
+        W = self._W
+        W[:] = (
+            (-h * qx, -h * qy, -h * qz),
+            (h * qw, -h * qz, h * qy),
+            (h * qz, h * qw, -h * qx),
+            (-h * qy, h * qx, h * qw),
+        )
+        Qt, Pt = self._Qt, self._Pt
+        np.matmul(W, W.T, out=Qt)
+        Qt *= self.g_noise
+        np.matmul(F, self.P, out=self._FP)
+        np.matmul(self._FP, F.T, out=Pt)
+        Pt += Qt
+
+        # ----- correction -----
+        # expected measurement, reference vectors rotated by the normalised prediction
+        n = math.sqrt(tw * tw + tx * tx + ty * ty + tz * tz)
+        w, x, y, zq = tw / n, tx / n, ty / n, tz / n
+        c00, c01, c02 = 1.0 - 2.0 * (y * y + zq * zq), 2.0 * (x * y - w * zq), 2.0 * (x * zq + w * y)
+        c10, c11, c12 = 2.0 * (x * y + w * zq), 1.0 - 2.0 * (x * x + zq * zq), 2.0 * (y * zq - w * x)
+        c20, c21, c22 = 2.0 * (x * zq - w * y), 2.0 * (w * x + y * zq), 1.0 - 2.0 * (x * x + y * y)
+
+        H, v = buffers["H"], buffers["v"]
+        rows, residual = [], []
+        refs = (self.a_ref, self.m_ref) if len(z) == 6 else (self.a_ref,)
+        for i, (rx, ry, rz) in enumerate(refs):
+            # H is linearised around the unnormalised prediction, as in ahrs
+            rows += [
+                (2.0 * (rx * tw + ry * tz - rz * ty), 2.0 * (rx * tx + ry * ty + rz * tz), 2.0 * (-rx * ty + ry * tx - rz * tw), 2.0 * (-rx * tz + ry * tw + rz * tx)),
+                (2.0 * (-rx * tz + ry * tw + rz * tx), 2.0 * (rx * ty - ry * tx + rz * tw), 2.0 * (rx * tx + ry * ty + rz * tz), 2.0 * (-rx * tw - ry * tz + rz * ty)),
+                (2.0 * (rx * ty - ry * tx + rz * tw), 2.0 * (rx * tz - ry * tw - rz * tx), 2.0 * (rx * tw + ry * tz - rz * ty), 2.0 * (rx * tx + ry * ty + rz * tz)),
+            ]
+            k = 3 * i
+            residual += [
+                z[k] - (c00 * rx + c10 * ry + c20 * rz),
+                z[k + 1] - (c01 * rx + c11 * ry + c21 * rz),
+                z[k + 2] - (c02 * rx + c12 * ry + c22 * rz),
+            ]
+        H[:] = rows
+        v[:] = residual
+
+        # S = H P_t H^T + R, K = P_t H^T S^-1
+        HP, PHt, S, K = buffers["HP"], buffers["PHt"], buffers["S"], buffers["K"]
+        np.matmul(H, Pt, out=HP)
+        np.matmul(HP, H.T, out=S)
+        buffers["S_diag"] += buffers["R"]
+        np.matmul(Pt, H.T, out=PHt)
+        # the only temporary left, LAPACK has no in place inverse through numpy
+        np.matmul(PHt, np.linalg.inv(S), out=K)
+
+        # P = (I - K H) P_t, q = q_t + K v
+        KH = self._KH
+        np.matmul(K, H, out=KH)
+        np.subtract(self._identity, KH, out=KH)
+        np.matmul(KH, Pt, out=self.P)
+        np.matmul(K, v, out=self._Kv)
+        kw, kx, ky, kz = self._Kv.tolist()
+        qw, qx, qy, qz = tw + kw, tx + kx, ty + ky, tz + kz
+        n = math.sqrt(qw * qw + qx * qx + qy * qy + qz * qz)
+        self.q[:] = (qw / n, qx / n, qy / n, qz / n)
+        return self.q
+
+
+def compare_with_ahrs(gyr, acc, mag=None, frequency: float = 100.0, frame: str = "NED") -> dict:
+    """ Run both filters over the same samples, largest difference and time per sample """
+    import time
+
+    started = time.perf_counter()
+    reference = EKF(gyr=gyr, acc=acc, mag=mag, frequency=frequency, frame=frame).Q
+    ahrs_seconds = time.perf_counter() - started
+
+    started = time.perf_counter()
+    fast = QuaternionEKF(frequency, frame).estimate_all(gyr, acc, mag)
+    fast_seconds = time.perf_counter() - started
+
+    return {
+        "samples": len(acc),
+        "max_abs_diff": float(np.abs(fast - reference).max()),
+        "ahrs_us_per_sample": ahrs_seconds / len(acc) * 1e6,
+        "fast_us_per_sample": fast_seconds / len(acc) * 1e6,
+        "speedup": ahrs_seconds / fast_seconds,
+    }
+
+
+def main():
+    import argparse
+
+    from imu_log import load_csv_streams
+
+    parser = argparse.ArgumentParser(description="Check QuaternionEKF against ahrs.filters.EKF on recorded csv streams")
+    parser.add_argument("acc")
+    parser.add_argument("gyro")
+    parser.add_argument("mag")
+    parser.add_argument("--frame", default="NED")
+    parser.add_argument("--tolerance", type=float, default=1e-9)
+    args = parser.parse_args()
+
+    acc, gyro, mag = load_csv_streams(args.acc, args.gyro, args.mag)
+    failed = False
+    for label, m in (("acc+mag", mag), ("acc only", None)):
+        result = compare_with_ahrs(gyro, acc, m, frame=args.frame)
+        ok = result["max_abs_diff"] <= args.tolerance
+        failed |= not ok
+        print(f"{label}: {'ok' if ok else 'MISMATCH'} {result}")
+    raise SystemExit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
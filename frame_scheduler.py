@@ -0,0 +1,60 @@
+import time
+
+
+class FrameScheduler:
+    """
+    Decides when the viewer redraws
+
+    A frame is drawn only when the orientation changed, and at most
+    `target_fps` times a second. When nothing changed for `idle_after`
+    seconds the loop only wakes up `idle_fps` times a second, to handle
+    window events and pick up new estimates.
+    """
+
+    def __init__(self, target_fps: float = 60.0, idle_fps: float = 5.0, idle_after: float = 2.0):
+        if target_fps <= 0 or idle_fps <= 0:
+            raise ValueError("Frame rates must be positive")
+        self.frame_interval = 1.0 / target_fps
+        self.idle_interval = 1.0 / idle_fps
+        self.idle_after = idle_after
+
+        self._version = None
+        self._last_frame = 0.0
+        self._last_change = time.monotonic()
+
+        self.frames = 0
+        self.deferred = 0
+
+    @property
+    def idle(self) -> bool:
+        return time.monotonic() - self._last_change > self.idle_after
+
+    def timeout(self) -> float:
+        """ Seconds the loop can block on window events before the next frame slot """
+        remaining = self._last_frame + self.frame_interval - time.monotonic()
+        if remaining > 0:
+            return remaining
+        # slot has passed without anything new, poll at the frame or idle rate
+        return self.idle_interval if self.idle else self.frame_interval
+
+    def invalidate(self) -> None:
+        """ Force a redraw on the next slot, e.g. after the window was exposed or resized """
+        self._version = None
+
+    def should_draw(self, version) -> bool:
+        """
+        version: anything that changes when there is something new to draw,
+                 e.g. the number of estimates received so far
+        """
+        if version == self._version:
+            return False
+        now = time.monotonic()
+        if now - self._last_frame < self.frame_interval:
+            # too early, it will be drawn on the next slot
+            self.deferred += 1
+            return False
+        self._version = version
+        self._last_frame = now
+        self._last_change = now
+        self.frames += 1
+        return True
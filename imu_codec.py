@@ -0,0 +1,129 @@
+import json
+import struct
+
+import numpy as np
+
+# binary payload layout on stream/imu (little endian)
+#   header: magic "IMU", version (u8), sample count (u16), reserved (u16)
+#   body:   count x 10 f64 [timestamp, acc xyz, gyro xyz, mag xyz]
+MAGIC = b"IMU"
+VERSION = 1
+HEADER = struct.Struct("<3sBHH")
+MAX_SAMPLES = 0xFFFF
+
+SAMPLE_DTYPE = np.dtype(
+    [
+        ("timestamp", "<f8"),
+        ("acc", "<f8", (3,)),
+        ("gyro", "<f8", (3,)),
+        ("mag", "<f8", (3,)),
+    ]
+)
+
+
+def empty_samples(count: int) -> np.ndarray:
+    """ Allocate a zeroed array of `count` samples in the wire layout """
+    return np.zeros(count, dtype=SAMPLE_DTYPE)
+
+
+def is_binary(payload: bytes) -> bool:
+    return payload[: len(MAGIC)] == MAGIC
+
+
+def encode(samples: np.ndarray) -> bytes:
+    """
+    Pack samples into a binary stream/imu payload
+
+    samples: np.ndarray with dtype SAMPLE_DTYPE, shape (N,)
+    output: header followed by the N fixed width records
+    """
+    samples = np.ascontiguousarray(samples, dtype=SAMPLE_DTYPE)
+    if samples.ndim != 1 or len(samples) > MAX_SAMPLES:
+        raise ValueError(f"Expected at most {MAX_SAMPLES} samples in a 1d array")
+    return HEADER.pack(MAGIC, VERSION, len(samples), 0) + samples.tobytes()
+
+
+def _binary_count(payload: bytes) -> int:
+    """ Validate a binary payload's header and size, returns its sample count """
+    if len(payload) < HEADER.size:
+        raise ValueError(f"Payload too short for header: {len(payload)} bytes")
+    magic, version, count, _ = HEADER.unpack_from(payload)
+    if magic != MAGIC:
+        raise ValueError(f"Bad magic {magic!r}")
+    if version != VERSION:
+        raise ValueError(f"Unsupported payload version {version}")
+    expected = HEADER.size + count * SAMPLE_DTYPE.itemsize
+    if len(payload) != expected:
+        raise ValueError(f"Payload is {len(payload)} bytes, header says {expected}")
+    return count
+
+
+def encode_json(samples: np.ndarray) -> bytes:
+    """ Pack samples into the legacy JSON payload, a single object for one sample """
+    measurements = []
+    for sample in samples:
+        measurement = {"timestamp": float(sample["timestamp"])}
+        for sensor in ("acc", "gyro", "mag"):
+            measurement[sensor] = dict(zip("xyz", sample[sensor].tolist()))
+        measurements.append(measurement)
+    if len(measurements) == 1:
+        measurements = measurements[0]
+    return json.dumps(measurements).encode("utf-8")
+
+
+def decode_binary(payload: bytes) -> np.ndarray:
+    """
+    Decode a binary payload without copying
+
+    The returned array is a read-only view over `payload`
+    """
+    count = _binary_count(payload)
+    return np.frombuffer(payload, dtype=SAMPLE_DTYPE, count=count, offset=HEADER.size)
+
+
+def decode_json(payload) -> np.ndarray:
+    """
+    Decode the legacy JSON payload
+
+    payload: '{"acc": {"x": .., "y": .., "z": ..}, "gyro": {..}, "mag": {..}}'
+             or a list of such objects, with an optional "timestamp" key
+    """
+    if isinstance(payload, (bytes, bytearray, memoryview)):
+        payload = bytes(payload).decode("utf-8")
+    measurements = json.loads(payload)
+    if isinstance(measurements, dict):
+        measurements = [measurements]
+
+    samples = empty_samples(len(measurements))
+    for sample, measurement in zip(samples, measurements):
+        sample["timestamp"] = measurement.get("timestamp", np.nan)
+        for sensor in ("acc", "gyro", "mag"):
+            xyz = measurement[sensor]
+            sample[sensor] = (xyz["x"], xyz["y"], xyz["z"])
+    return samples
+
+
+def decode(payload) -> np.ndarray:
+    """ Decode a stream/imu payload in either the binary or the JSON format """
+    if is_binary(payload):
+        return decode_binary(payload)
+    return decode_json(payload)
+
+
+def decode_many(payloads) -> np.ndarray:
+    """
+    Decode several payloads into one array of samples, in arrival order
+
+    Binary payloads are validated and their bodies joined into one
+    buffer that is parsed in a single frombuffer call, so a burst costs
+    one decode instead of one per payload. Raises ValueError if any
+    payload is bad.
+    """
+    if len(payloads) == 1:
+        return decode(payloads[0])
+    if all(is_binary(payload) for payload in payloads):
+        for payload in payloads:
+            _binary_count(payload)
+        body = b"".join(memoryview(payload)[HEADER.size :] for payload in payloads)
+        return np.frombuffer(body, dtype=SAMPLE_DTYPE)
+    return np.concatenate([decode(payload) for payload in payloads])
@@ -0,0 +1,255 @@
+import json
+import struct
+
+import numpy as np
+from fast_ekf import QuaternionEKF
+
+# pandas is imported by the csv and json loaders only, mapping a columnar log doesn't need it
+
+SENSORS = ("acc", "gyro", "mag")
+AXES = ("x", "y", "z")
+
+# timestamps in the phone's csv exports, e.g. 22-May-2021 11:42:54.146
+CSV_TIME_FORMAT = "%d-%b-%Y %H:%M:%S.%f"
+# (character position, seconds) of the HH:MM:SS.mmm digits in that format
+TIME_OF_DAY_DIGITS = (
+    (12, 36000.0), (13, 3600.0), (15, 600.0), (16, 60.0), (18, 10.0), (19, 1.0), (21, 0.1), (22, 0.01), (23, 0.001)
+)
+
+# columnar log layout (little endian)
+#   header: magic "IMUCOL", version (u8), padding, sample count (u64)
+#   columns, each N rows of f64: timestamp (1), acc (3), gyro (3), mag (3), quat (4)
+COLUMNAR_SUFFIX = ".imucol"
+COLUMNAR_MAGIC = b"IMUCOL"
+COLUMNAR_VERSION = 1
+COLUMNAR_HEADER = struct.Struct("<6sBxQ")
+COLUMNS = (("timestamp", 1), ("acc", 3), ("gyro", 3), ("mag", 3), ("quat", 4))
+
+
+def load_json_log(path: str):
+    """
+    Load a recorded log into contiguous (N, 3) float arrays
+
+    log: [{'acc': {'x', 'y', 'z'}, 'gyro': {..}, 'mag': {..}}, ...]
+    output: acc, gyro, mag
+    """
+    import pandas as pd
+
+    with open(path) as f:
+        records = json.load(f)
+
+    # flatten the nested records into columns acc.x, acc.y, ... in one pass
+    columns = [f"{sensor}.{axis}" for sensor in SENSORS for axis in AXES]
+    flat = pd.json_normalize(records)[columns].to_numpy(dtype=np.float64)
+
+    # (N, 9) -> (3, N, 3) so every sensor is its own contiguous block
+    acc, gyro, mag = np.ascontiguousarray(flat.reshape(-1, 3, 3).transpose(1, 0, 2))
+    return acc, gyro, mag
+
+
+def load_csv(path: str) -> np.ndarray:
+    """ Load the X, Y, Z columns of a sensor csv export into an (N, 3) float array """
+    import pandas as pd
+
+    frame = pd.read_csv(path, usecols=["X", "Y", "Z"])
+    return np.ascontiguousarray(frame.to_numpy(dtype=np.float64))
+
+
+def parse_csv_timestamps(values) -> np.ndarray:
+    """
+    Parse csv export timestamps into seconds since the epoch
+
+    The format is fixed width (22-May-2021 11:42:54.146), so the time of
+    day is decoded with array arithmetic and only the rows where the date
+    changes go through pandas.
+    """
+    import pandas as pd
+
+    raw = np.asarray(values, dtype="S")
+    chars = raw.view(np.uint8).reshape(len(raw), raw.dtype.itemsize)
+    if raw.dtype.itemsize != 24 or not (np.all(chars[:, 20] == ord(".")) and np.all(chars[:, 23])):
+        # not the usual layout, let pandas handle it
+        times = pd.to_datetime(pd.Series(values), format=CSV_TIME_FORMAT)
+        return times.to_numpy(dtype="datetime64[ns]").astype(np.int64) / 1e9
+
+    time_of_day = np.zeros(len(raw))
+    for column, weight in TIME_OF_DAY_DIGITS:
+        time_of_day += (chars[:, column] - ord("0")) * weight
+
+    # the date part, 22-May-2021, changes at most a few times per recording
+    dates = chars[:, :11]
+    starts = np.flatnonzero(np.r_[True, np.any(dates[1:] != dates[:-1], axis=1)])
+    names = [bytes(dates[i]).decode("ascii") for i in starts]
+    midnight = pd.to_datetime(pd.Series(names), format="%d-%b-%Y").to_numpy(dtype="datetime64[s]").astype(np.int64)
+    lengths = np.diff(np.r_[starts, len(raw)])
+    return np.repeat(midnight, lengths) + time_of_day
+
+
+def load_timed_csv(path: str):
+    """
+    Load a sensor csv export with its timestamps
+
+    output: timestamps in seconds since the epoch (N,), X Y Z (N, 3)
+    """
+    import pandas as pd
+
+    frame = pd.read_csv(path)
+    timestamp = parse_csv_timestamps(frame["Timestamp"].to_numpy())
+    xyz = np.ascontiguousarray(frame[["X", "Y", "Z"]].to_numpy(dtype=np.float64))
+    return timestamp, xyz
+
+
+def resample(timestamp: np.ndarray, values: np.ndarray, clock: np.ndarray, method: str = "interp"):
+    """
+    Sample a timestamped (N, 3) stream at the times in `clock`
+
+    method: "interp" for linear interpolation, "nearest" for the closest sample
+    """
+    if np.any(np.diff(timestamp) < 0):
+        order = np.argsort(timestamp, kind="stable")
+        timestamp, values = timestamp[order], values[order]
+
+    if method == "interp":
+        out = np.empty((len(clock), values.shape[1]))
+        for axis in range(values.shape[1]):
+            out[:, axis] = np.interp(clock, timestamp, values[:, axis])
+        return out
+    if method == "nearest":
+        right = np.clip(np.searchsorted(timestamp, clock), 1, len(timestamp) - 1)
+        left = right - 1
+        nearest = np.where(clock - timestamp[left] <= timestamp[right] - clock, left, right)
+        return np.ascontiguousarray(values[nearest])
+    raise ValueError(f"Unknown resampling method {method!r}, expected 'interp' or 'nearest'")
+
+
+def align_streams(timestamps, streams, method: str = "interp", rate: float = None):
+    """
+    Put several timestamped streams on one common clock
+
+    The clock covers only the range where every stream has samples. It is
+    the first stream's own timestamps, or a regular grid at `rate` Hz.
+    output: clock (M,), [stream (M, 3), ...]
+    """
+    start = max(t[0] for t in timestamps)
+    end = min(t[-1] for t in timestamps)
+    if start > end:
+        raise ValueError("Streams do not overlap in time")
+    if rate is None:
+        first = timestamps[0]
+        clock = first[(first >= start) & (first <= end)]
+    else:
+        clock = start + np.arange(int((end - start) * rate) + 1) / rate
+    return clock, [resample(t, v, clock, method) for t, v in zip(timestamps, streams)]
+
+
+def load_aligned_csv_streams(acc_path: str, gyro_path: str, mag_path: str, method: str = "interp", rate: float = None):
+    """
+    Load the three sensor csv exports onto one clock, see align_streams
+
+    output: clock, acc, gyro, mag
+    """
+    loaded = [load_timed_csv(path) for path in (acc_path, gyro_path, mag_path)]
+    clock, (acc, gyro, mag) = align_streams([t for t, _ in loaded], [v for _, v in loaded], method, rate)
+    return clock, acc, gyro, mag
+
+
+def load_csv_streams(acc_path: str, gyro_path: str, mag_path: str, method: str = "interp", rate: float = None):
+    """
+    Load the three sensor csv exports
+
+    The sensors are sampled at slightly different times, gyro and mag are
+    resampled onto the acc timestamps (or a `rate` Hz grid)
+    """
+    _, acc, gyro, mag = load_aligned_csv_streams(acc_path, gyro_path, mag_path, method, rate)
+    return acc, gyro, mag
+
+
+class ColumnarLog:
+    """
+    Memory mapped columnar log
+
+    Columns are read-only (N, width) views into the file, nothing is read
+    from disk until it is used, so opening and seeking are instant.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._map = np.memmap(path, dtype=np.uint8, mode="r")
+        magic, version, count = COLUMNAR_HEADER.unpack_from(self._map)
+        if magic != COLUMNAR_MAGIC:
+            raise ValueError(f"{path} is not a columnar log")
+        if version != COLUMNAR_VERSION:
+            raise ValueError(f"Unsupported columnar log version {version}")
+        self.count = count
+
+        offset = COLUMNAR_HEADER.size
+        for name, width in COLUMNS:
+            column = np.frombuffer(self._map, dtype="<f8", count=count * width, offset=offset)
+            setattr(self, name, column if width == 1 else column.reshape(count, width))
+            offset += column.nbytes
+
+    def __len__(self) -> int:
+        return self.count
+
+    @property
+    def duration(self) -> float:
+        return float(self.timestamp[-1] - self.timestamp[0]) if self.count else 0.0
+
+    def index_at(self, t: float) -> int:
+        """ Index of the last sample at or before `t` seconds from the start of the log """
+        index = np.searchsorted(self.timestamp, self.timestamp[0] + t, side="right") - 1
+        return int(np.clip(index, 0, self.count - 1))
+
+
+def write_columnar(path: str, timestamp, acc, gyro, mag, quat) -> None:
+    arrays = dict(timestamp=timestamp, acc=acc, gyro=gyro, mag=mag, quat=quat)
+    count = len(timestamp)
+    with open(path, "wb") as f:
+        f.write(COLUMNAR_HEADER.pack(COLUMNAR_MAGIC, COLUMNAR_VERSION, count))
+        for name, width in COLUMNS:
+            column = np.ascontiguousarray(arrays[name], dtype="<f8")
+            if column.size != count * width:
+                raise ValueError(f"Column {name} has {column.size} values, expected {count * width}")
+            f.write(column.tobytes())
+
+
+def convert_json_log(src: str, dst: str, frequency: float = 20.0) -> None:
+    """
+    Convert a json log to a columnar log
+
+    json logs have no timestamps, samples are spaced 1 / frequency apart
+    """
+    acc, gyro, mag = load_json_log(src)
+    timestamp = np.arange(len(acc)) / frequency
+    quat = QuaternionEKF(frequency).estimate_all(gyro, acc, mag)
+    write_columnar(dst, timestamp, acc, gyro, mag, quat)
+
+
+def convert_csv_streams(acc_path: str, gyro_path: str, mag_path: str, dst: str) -> None:
+    """ Convert the three sensor csv exports to a columnar log """
+    timestamp, acc, gyro, mag = load_aligned_csv_streams(acc_path, gyro_path, mag_path)
+    frequency = 1.0 / np.median(np.diff(timestamp))
+    quat = QuaternionEKF(frequency).estimate_all(gyro, acc, mag)
+    write_columnar(dst, timestamp, acc, gyro, mag, quat)
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Convert json or csv logs to a columnar log")
+    parser.add_argument("src", nargs="+", help="log.json, or acc.csv ang_vel.csv mag.csv")
+    parser.add_argument("dst", help=f"output file, usually *{COLUMNAR_SUFFIX}")
+    parser.add_argument("--frequency", type=float, default=20.0, help="sample rate of json logs")
+    args = parser.parse_args()
+
+    if len(args.src) == 1:
+        convert_json_log(args.src[0], args.dst, args.frequency)
+    elif len(args.src) == 3:
+        convert_csv_streams(*args.src, args.dst)
+    else:
+        parser.error("expected one json log or three csv files")
+    print(f"Wrote {len(ColumnarLog(args.dst))} samples to {args.dst}")
+
+
+if __name__ == "__main__":
+    main()
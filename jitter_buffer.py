@@ -0,0 +1,200 @@
+import heapq
+import math
+
+import numpy as np
+
+from imu_codec import SAMPLE_DTYPE
+from metrics import NULL_METRICS
+
+
+class JitterBuffer:
+    """
+    Puts samples back in timestamp order and gives each its true dt
+
+    Samples are held until they are `latency` seconds behind the newest
+    timestamp seen, or were received `latency` seconds ago, whichever
+    comes first, so a sample overtaken on the way can still slot in
+    before the ones after it are filtered. The buffer adds at most
+    `latency` seconds and nothing once the stream stalls.
+
+    A sample is late when it turns up after a newer one was already
+    released, it is dropped rather than fed to the filter backwards. dt
+    is the difference to the previously released timestamp, 0 for a
+    repeated one. The first sample, samples without a timestamp (legacy
+    JSON) and gaps longer than `max_dt`, e.g. after the phone paused, get
+    `nominal_dt` instead.
+
+    A sample more than `max_dt` behind the newest one is set aside. Once
+    `restart_samples` of them in a row agree, e.g. the publisher looped or
+    the phone's clock restarted, they start a new stream: what is still
+    held of the old one is released first, then the new one from its
+    first sample. Set aside samples that the stream carries on past are
+    late.
+
+    Not thread safe, owned by the filter worker or task.
+    """
+
+    def __init__(
+        self,
+        latency: float = 0.03,
+        nominal_dt: float = 0.05,
+        max_dt: float = 0.5,
+        capacity: int = 4096,
+        restart_samples: int = 3,
+        metrics=NULL_METRICS,
+    ):
+        if latency < 0:
+            raise ValueError(f"Latency budget can't be negative, got {latency}")
+        self.latency = latency
+        self.nominal_dt = nominal_dt
+        self.max_dt = max_dt
+        self.capacity = capacity
+        self.restart_samples = restart_samples
+        # (timestamp, sequence, receive time, samples, row)
+        self._heap = []
+        # far behind the newest, until they turn out late or a new stream
+        self._behind = []
+        # old streams' samples released before the next pop's, None where a new stream starts
+        self._draining = []
+        self._sequence = 0
+        self._newest = -math.inf
+        self._last_released = None
+
+        self.pushed = 0
+        self.released = 0
+        self.late = 0
+        self.gaps = 0
+        self.restarts = 0
+        self.untimed = 0
+        self.forced = 0
+
+        self.metrics = metrics
+        metrics.gauge("jitter_depth", self.__len__)
+        metrics.gauge("samples_late", lambda: self.late)
+
+    def __len__(self) -> int:
+        draining = len(self._draining) - self._draining.count(None)
+        return len(self._heap) + len(self._behind) + draining
+
+    def push(self, samples: np.ndarray, received: float) -> None:
+        """ samples: array of SAMPLE_DTYPE, received: time.perf_counter() of arrival """
+        heap = self._heap
+        for row, timestamp in enumerate(samples["timestamp"].tolist()):
+            if math.isnan(timestamp):
+                # nothing to order by, released on the next pop in arrival order
+                timestamp = -math.inf
+                self.untimed += 1
+            elif timestamp < self._newest - self.max_dt:
+                self._set_aside((timestamp, self._sequence, received, samples, row))
+                self._sequence += 1
+                continue
+            else:
+                if self._behind:
+                    # the stream carried on, they were stragglers
+                    self.late += len(self._behind)
+                    self._behind.clear()
+                if timestamp > self._newest:
+                    self._newest = timestamp
+            heapq.heappush(heap, (timestamp, self._sequence, received, samples, row))
+            self._sequence += 1
+        self.pushed += len(samples)
+
+    def _set_aside(self, item) -> None:
+        behind = self._behind
+        if behind and abs(item[0] - behind[-1][0]) > self.max_dt:
+            # doesn't follow on from the ones before, they were stragglers
+            self.late += len(behind)
+            behind.clear()
+        behind.append(item)
+        if len(behind) < self.restart_samples:
+            return
+        # a new stream, the old one's held samples go out first
+        self.restarts += 1
+        self._draining.extend(sorted(self._heap))
+        self._draining.append(None)
+        self._heap[:] = behind
+        heapq.heapify(self._heap)
+        self._newest = max(timestamp for timestamp, *_ in behind)
+        behind.clear()
+
+    def timeout(self, now: float) -> float:
+        """ Seconds until the oldest held sample is released, None when empty """
+        if self._draining:
+            return 0.0
+        if not self._heap:
+            return None
+        timestamp, _, received, _, _ = self._heap[0]
+        if timestamp <= self._newest - self.latency:
+            return 0.0
+        return max(0.0, received + self.latency - now)
+
+    def pop(self, now: float, flush: bool = False):
+        """
+        Release every sample that is due, oldest timestamp first
+
+        Returns the samples, their dt (N,) and the newest receive time
+        among them (None if nothing was released)
+        """
+        heap = self._heap
+        due, self._draining = self._draining, []
+        if flush and self._behind:
+            # nothing left to confirm them
+            self.late += len(self._behind)
+            self._behind.clear()
+        while heap:
+            timestamp, _, received, samples, row = heap[0]
+            if not (flush or timestamp <= self._newest - self.latency or received + self.latency <= now):
+                if len(heap) <= self.capacity:
+                    break
+                # full, make room even though the budget isn't used up
+                self.forced += 1
+            due.append(heapq.heappop(heap))
+
+        out = np.empty(len(due), dtype=SAMPLE_DTYPE)
+        dt = np.empty(len(due))
+        count = 0
+        newest_received = None
+        for item in due:
+            if item is None:
+                # the old stream is out, dt starts over
+                self._last_released = None
+                continue
+            timestamp, _, received, samples, row = item
+            last = self._last_released
+            if timestamp == -math.inf:
+                dt[count] = self.nominal_dt
+            else:
+                if last is not None and timestamp < last:
+                    self.late += 1
+                    continue
+                if last is None or timestamp - last > self.max_dt:
+                    if last is not None:
+                        self.gaps += 1
+                    dt[count] = self.nominal_dt
+                else:
+                    # 0 for a repeated timestamp, the time up to it was covered by the first
+                    dt[count] = timestamp - last
+                self._last_released = timestamp
+            out[count] = samples[row]
+            count += 1
+            newest_received = received if newest_received is None else max(newest_received, received)
+            if self.metrics.enabled:
+                self.metrics.observe("jitter_hold", now - received)
+        self.released += count
+        return out[:count], dt[:count], newest_received
+
+    def flush(self, now: float):
+        """ Release everything still held, e.g. on shutdown """
+        return self.pop(now, flush=True)
+
+    def stats(self) -> dict:
+        return {
+            "depth": len(self),
+            "pushed": self.pushed,
+            "released": self.released,
+            "late": self.late,
+            "gaps": self.gaps,
+            "restarts": self.restarts,
+            "untimed": self.untimed,
+            "forced": self.forced,
+        }
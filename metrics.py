@@ -0,0 +1,138 @@
+import bisect
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# histogram bucket upper bounds in seconds, 1us to 10s, 5 per decade
+BUCKET_BOUNDS = [10 ** (exponent / 5) for exponent in range(-30, 6)]
+
+
+class Histogram:
+    """
+    Latency histogram over the last `window` seconds
+
+    Counts are kept per time slot, slots older than the window are
+    reused, so a snapshot only reflects recent samples.
+    """
+
+    def __init__(self, window: float = 10.0, slots: int = 10):
+        self.slot_seconds = window / slots
+        self._counts = [[0] * (len(BUCKET_BOUNDS) + 1) for _ in range(slots)]
+        self._slot_ids = [-1] * slots
+        self.total = 0
+
+    def observe(self, seconds: float) -> None:
+        slot_id = int(time.monotonic() / self.slot_seconds)
+        i = slot_id % len(self._counts)
+        if self._slot_ids[i] != slot_id:
+            self._counts[i] = [0] * (len(BUCKET_BOUNDS) + 1)
+            self._slot_ids[i] = slot_id
+        self._counts[i][bisect.bisect_left(BUCKET_BOUNDS, seconds)] += 1
+        self.total += 1
+
+    def snapshot(self) -> dict:
+        newest = int(time.monotonic() / self.slot_seconds)
+        counts = [0] * (len(BUCKET_BOUNDS) + 1)
+        for slot_id, slot in zip(self._slot_ids, self._counts):
+            if newest - slot_id < len(self._counts):
+                counts = [a + b for a, b in zip(counts, slot)]
+
+        count = sum(counts)
+        summary = {"count": count, "total": self.total}
+        for name, quantile in (("p50_us", 0.5), ("p90_us", 0.9), ("p99_us", 0.99)):
+            summary[name] = self._quantile(counts, count, quantile)
+        return summary
+
+    @staticmethod
+    def _quantile(counts, count, quantile):
+        """ Upper bound of the bucket holding the quantile, in microseconds """
+        if count == 0:
+            return None
+        seen = 0
+        for bound, bucket_count in zip(BUCKET_BOUNDS + [float("inf")], counts):
+            seen += bucket_count
+            if seen >= quantile * count:
+                return bound * 1e6
+        return None
+
+
+class Metrics:
+    """
+    Per stage latency histograms and gauges
+
+    Stages call `observe(name, seconds)`, gauges are functions sampled
+    when a snapshot is taken, e.g. queue depths.
+    """
+
+    enabled = True
+
+    def __init__(self, window: float = 10.0):
+        self.window = window
+        self.histograms = {}
+        self.gauges = {}
+        self._server = None
+
+    def observe(self, name: str, seconds: float) -> None:
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms.setdefault(name, Histogram(self.window))
+        histogram.observe(seconds)
+
+    def gauge(self, name: str, read) -> None:
+        self.gauges[name] = read
+
+    def snapshot(self) -> dict:
+        return {
+            "time": time.time(),
+            "window_s": self.window,
+            "latency": {name: h.snapshot() for name, h in list(self.histograms.items())},
+            "gauges": {name: read() for name, read in list(self.gauges.items())},
+        }
+
+    def dump(self, path: str) -> None:
+        with open(path, "w") as f:
+            json.dump(self.snapshot(), f, indent=2)
+
+    def serve(self, port: int, host: str = "127.0.0.1") -> None:
+        """ Serve snapshots as json on http://host:port/ from a background thread """
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = json.dumps(metrics.snapshot()).encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=self._server.serve_forever, name="metrics", daemon=True).start()
+        print(f"Serving metrics on http://{host}:{self._server.server_port}/")
+
+    def close(self) -> None:
+        if self._server is not None:
+            self._server.shutdown()
+            self._server = None
+
+
+class NullMetrics:
+    """ Stand-in when metrics are off, every call is a no-op """
+
+    enabled = False
+
+    def observe(self, name: str, seconds: float) -> None:
+        pass
+
+    def gauge(self, name: str, read) -> None:
+        pass
+
+    def close(self) -> None:
+        pass
+
+
+NULL_METRICS = NullMetrics()
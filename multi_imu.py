@@ -0,0 +1,231 @@
+import multiprocessing
+import queue
+import threading
+import time
+import zlib
+
+import numpy as np
+import imu_codec
+from jitter_buffer import JitterBuffer
+from orientation_filters import make_filter
+from ring_buffer import RingBuffer
+
+# one topic per device, e.g. stream/imu/forearm
+device_topic_prefix = "stream/imu/"
+device_topic = device_topic_prefix + "+"
+
+
+def device_id_from_topic(topic: str) -> str:
+    return topic[len(device_topic_prefix) :]
+
+
+class DeviceFilter:
+    """
+    Filter state for one IMU, same setup as OrientationViewer.update_estimate
+
+    With a `jitter_latency`, the device's samples go through its own
+    JitterBuffer and are filtered in timestamp order with their dt, as
+    on the viewer's pipeline, otherwise in arrival order with a fixed dt.
+    """
+
+    def __init__(self, frequency: float = 20.0, frame: str = "ENU", filter_name: str = "ekf", jitter_latency: float = None):
+        self.filter = make_filter(filter_name, frequency, frame)
+        self.reorder = None
+        if jitter_latency is not None:
+            self.reorder = JitterBuffer(jitter_latency, nominal_dt=self.filter.Dt)
+        self.started = False
+        self.q = None
+
+    def update(self, sample, dt: float = None) -> np.ndarray:
+        acc, gyro, mag = sample["acc"], sample["gyro"], sample["mag"]
+        if not self.started:
+            self.q = self.filter.reset(acc, mag)
+            self.started = True
+        else:
+            self.q = self.filter.update(gyro, acc, mag, dt)
+        return self.q
+
+    def update_many(self, samples, dt=None) -> np.ndarray:
+        """ Estimates for every sample of a decoded payload, N x 4, dt: None or one per sample """
+        estimates = np.empty((len(samples), 4))
+        start = 0
+        if not self.started:
+            estimates[0] = self.update(samples[0])
+            start = 1
+        if start < len(samples):
+            rest = samples[start:]
+            rest_dt = None if dt is None else dt[start:]
+            estimates[start:] = self.filter.update_many(rest["gyro"], rest["acc"], rest["mag"], rest_dt)
+            # filter.q is in the filter's own frame, the estimates are in the one asked for
+            self.q = estimates[-1]
+        return estimates
+
+
+def _filter_samples(outbox, device_id, device, samples, dt, received) -> None:
+    try:
+        estimates = device.update_many(samples, dt)
+    except Exception as e:
+        # an uncaught exception would end the process and every device on it
+        print(f"Skipping payload from {device_id} the filter failed on: {e!r}")
+        return
+    outbox.put((device_id, received, estimates))
+
+
+def _shard_worker(inbox, outbox, frequency, frame, filter_name, jitter_latency):
+    """ Runs in a worker process and owns the filters of every device hashed to it """
+    filters = {}
+    while True:
+        # wake up when a held sample is due even if nothing new arrives
+        now = time.perf_counter()
+        timeouts = [device.reorder.timeout(now) for device in filters.values() if device.reorder is not None]
+        timeouts = [timeout for timeout in timeouts if timeout is not None]
+        try:
+            item = inbox.get(timeout=min(timeouts) if timeouts else None)
+        except queue.Empty:
+            item = ()
+        if item is None:
+            break
+        if item:
+            device_id, received, payload = item
+            try:
+                samples = imu_codec.decode(payload)
+            except Exception as e:
+                print(f"Dropping undecodable payload from {device_id}: {e}")
+                continue
+            device = filters.get(device_id)
+            if device is None:
+                device = filters[device_id] = DeviceFilter(frequency, frame, filter_name, jitter_latency)
+            if device.reorder is None:
+                _filter_samples(outbox, device_id, device, samples, None, received)
+                continue
+            # perf_counter is system wide, the receive time is comparable across processes
+            device.reorder.push(samples, time.perf_counter() if received is None else received)
+        now = time.perf_counter()
+        for device_id, device in filters.items():
+            if device.reorder is not None and len(device.reorder):
+                samples, dt, received = device.reorder.pop(now)
+                if len(samples):
+                    _filter_samples(outbox, device_id, device, samples, dt, received)
+
+
+class ShardedFilterPool:
+    """
+    Filters many IMUs on a pool of worker processes
+
+    Every device is pinned to one worker by a stable hash of its id, so
+    its samples stay in order and its filter state lives in one place,
+    while different devices are filtered in parallel on separate cores.
+    With a `jitter_latency`, each device's samples are put back in
+    timestamp order and filtered with their dt, see DeviceFilter.
+    Estimates come back on a collector thread and are kept in one
+    RingBuffer per device.
+    """
+
+    def __init__(
+        self,
+        workers: int = None,
+        history: int = 1024,
+        queue_size: int = 256,
+        frequency: float = 20.0,
+        frame: str = "ENU",
+        filter_name: str = "ekf",
+        jitter_latency: float = None,
+    ):
+        self.workers = workers or multiprocessing.cpu_count()
+        self.history = history
+        self.queue_size = queue_size
+        self.frequency = frequency
+        self.frame = frame
+        self.filter_name = filter_name
+        self.jitter_latency = jitter_latency
+        # device id -> RingBuffer of estimates, written only by the collector
+        self.devices = {}
+        # device id -> receive time of its latest estimate
+        self.latest_received = {}
+        # device id -> payloads dropped because its worker was behind
+        self.dropped = {}
+        self._inboxes = []
+        self._processes = []
+        self._outbox = None
+        self._collector = None
+
+    def start(self) -> None:
+        # spawned rather than forked, the viewer's network and pipeline threads
+        # are already running and a fork copies whatever locks they hold
+        context = multiprocessing.get_context("spawn")
+        self._outbox = context.Queue()
+        for i in range(self.workers):
+            inbox = context.Queue(self.queue_size)
+            process = context.Process(
+                target=_shard_worker,
+                args=(inbox, self._outbox, self.frequency, self.frame, self.filter_name, self.jitter_latency),
+                name=f"imu-shard-{i}",
+                daemon=True,
+            )
+            process.start()
+            self._inboxes.append(inbox)
+            self._processes.append(process)
+        self._collector = threading.Thread(target=self._collect, name="imu-collector", daemon=True)
+        self._collector.start()
+
+    def stop(self, timeout: float = 1.0) -> None:
+        """ Ask every worker to finish, the ones that can't take the request or don't exit are terminated """
+        stopping = []
+        for inbox, process in zip(self._inboxes, self._processes):
+            try:
+                # a dead worker never drains its queue, a blocking put would hang here
+                inbox.put(None, timeout=timeout if process.is_alive() else 0)
+                stopping.append((inbox, process))
+            except queue.Full:
+                self._terminate(inbox, process)
+        for inbox, process in stopping:
+            process.join(timeout)
+            if process.is_alive():
+                self._terminate(inbox, process)
+        if self._outbox is not None:
+            self._outbox.put(None)
+            self._collector.join(timeout)
+        self._inboxes, self._processes = [], []
+
+    @staticmethod
+    def _terminate(inbox, process) -> None:
+        print(f"Terminating {process.name}, exit code {process.exitcode}")
+        process.terminate()
+        process.join()
+        # whatever is still buffered for it is never read, don't wait on it at exit
+        inbox.cancel_join_thread()
+
+    def shard(self, device_id: str) -> int:
+        # crc32 rather than hash(), which is salted per process
+        return zlib.crc32(device_id.encode("utf-8")) % self.workers
+
+    def submit(self, device_id: str, payload: bytes, received: float = None) -> bool:
+        """ Never blocks, the payload is dropped if the device's worker is behind """
+        try:
+            self._inboxes[self.shard(device_id)].put_nowait((device_id, received, payload))
+            return True
+        except queue.Full:
+            self.dropped[device_id] = self.dropped.get(device_id, 0) + 1
+            return False
+
+    def history_of(self, device_id: str) -> RingBuffer:
+        return self.devices.get(device_id)
+
+    def _collect(self) -> None:
+        while True:
+            item = self._outbox.get()
+            if item is None:
+                break
+            device_id, received, estimates = item
+            history = self.devices.get(device_id)
+            if history is None:
+                history = self.devices[device_id] = RingBuffer(self.history, width=4)
+            # one step, readers never see half a payload
+            history.extend(estimates)
+            self.latest_received[device_id] = received
+
+    def stats(self) -> dict:
+        return {
+            device_id: {"estimates": history.count, "dropped": self.dropped.get(device_id, 0)}
+            for device_id, history in list(self.devices.items())
+        }
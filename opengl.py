@@ -1,10 +1,8 @@
 # https://github.com/thecountoftuscany/PyTeapot-Quaternion-Euler-cube-rotation
 import numpy as np
-import pandas as pd
 import math
-from ahrs.filters import EKF
-from ahrs.common.orientation import acc2q
-from ahrs.common.quaternion import QuaternionArray
+
+from attitude import ypr
 
 import pygame
 from pygame.locals import *
@@ -12,36 +10,71 @@ from OpenGL.GL import *
 from OpenGL.GLU import *
 
 
-def drawText(position, textString, size):
+# Declination at Chandrapur, Maharashtra is - 0 degress 13 min
+YAW_OFFSET = 1.15
+
+# printable ascii, each character is a display list at base + code
+GLYPH_CODES = range(32, 127)
+
+# box faces as (colour, corners), uploaded once into a display list
+BOX_FACES = [
+    ((0.0, 1.0, 0.0), [(1.0, 0.2, -1.0), (-1.0, 0.2, -1.0), (-1.0, 0.2, 1.0), (1.0, 0.2, 1.0)]),
+    ((1.0, 0.5, 0.0), [(1.0, -0.2, 1.0), (-1.0, -0.2, 1.0), (-1.0, -0.2, -1.0), (1.0, -0.2, -1.0)]),
+    ((1.0, 0.0, 0.0), [(1.0, 0.2, 1.0), (-1.0, 0.2, 1.0), (-1.0, -0.2, 1.0), (1.0, -0.2, 1.0)]),
+    ((1.0, 1.0, 0.0), [(1.0, -0.2, -1.0), (-1.0, -0.2, -1.0), (-1.0, 0.2, -1.0), (1.0, 0.2, -1.0)]),
+    ((0.0, 0.0, 1.0), [(-1.0, 0.2, 1.0), (-1.0, 0.2, -1.0), (-1.0, -0.2, -1.0), (-1.0, -0.2, 1.0)]),
+    ((1.0, 0.0, 1.0), [(1.0, 0.2, -1.0), (1.0, 0.2, 1.0), (1.0, -0.2, 1.0), (1.0, -0.2, -1.0)]),
+]
+
+# display lists live in the current GL context, initWindow resets them
+_box_list = None
+_glyph_bases = {}
+
+
+def compileGlyphs(size):
+    """ Render every glyph once and store it in a display list, returns the list base """
     font = pygame.font.SysFont("Courier", size, True)
-    textSurface = font.render(textString, True, (255, 255, 255, 255), (0, 0, 0, 255))
-    textData = pygame.image.tostring(textSurface, "RGBA", True)
+    base = glGenLists(GLYPH_CODES.stop)
+    for code in GLYPH_CODES:
+        glyph = font.render(chr(code), True, (255, 255, 255, 255), (0, 0, 0, 255))
+        glyphData = pygame.image.tostring(glyph, "RGBA", True)
+        glNewList(base + code, GL_COMPILE)
+        glDrawPixels(glyph.get_width(), glyph.get_height(), GL_RGBA, GL_UNSIGNED_BYTE, glyphData)
+        # advance the raster position to the next character
+        glBitmap(0, 0, 0, 0, glyph.get_width(), 0, b"\0")
+        glEndList()
+    return base
+
+
+def compileBox():
+    boxList = glGenLists(1)
+    glNewList(boxList, GL_COMPILE)
+    glBegin(GL_QUADS)
+    for colour, corners in BOX_FACES:
+        glColor3f(*colour)
+        for corner in corners:
+            glVertex3f(*corner)
+    glEnd()
+    glEndList()
+    return boxList
+
+
+def drawText(position, textString, size):
+    base = _glyph_bases.get(size)
+    if base is None:
+        base = _glyph_bases[size] = compileGlyphs(size)
     glRasterPos3d(*position)
-    glDrawPixels(
-        textSurface.get_width(),
-        textSurface.get_height(),
-        GL_RGBA,
-        GL_UNSIGNED_BYTE,
-        textData,
-    )
+    glListBase(base)
+    glCallLists(textString.encode("ascii", "replace"))
 
 
 def quat_to_ypr(q):
-    yaw = math.atan2(
-        2.0 * (q[1] * q[2] + q[0] * q[3]), q[0] * q[0] + q[1] * q[1] - q[2] * q[2] - q[3] * q[3]
-    )
-    pitch = -math.sin(2.0 * (q[1] * q[3] - q[0] * q[2]))
-    roll = math.atan2(
-        2.0 * (q[0] * q[1] + q[2] * q[3]), q[0] * q[0] - q[1] * q[1] - q[2] * q[2] + q[3] * q[3]
-    )
-    pitch *= 180.0 / math.pi
-    yaw *= 180.0 / math.pi
-    yaw -= -1.15  # Declination at Chandrapur, Maharashtra is - 0 degress 13 min
-    roll *= 180.0 / math.pi
-    return [yaw, pitch, roll]
-
-
-def draw(quat) -> None:
+    """ Yaw, pitch, roll in degrees of one quaternion, or (N, 3) of a whole (N, 4) trajectory """
+    return ypr(q, YAW_OFFSET)
+
+
+def draw(quat, angles=None) -> None:
+    """ angles: yaw, pitch, roll of `quat` if already converted, e.g. with quat_to_ypr on a whole log """
     # psi, theta, phi -> # yaw, pitch, roll
 
     # ? roll(x), pitch(y), yaw(z) -> Normal
@@ -51,7 +84,7 @@ def draw(quat) -> None:
     # [ 0.63203606  0.04095045 -0.27498346 -0.72335163]
     [w, nx, ny, nz] = quat
 
-    [yaw, pitch, roll] = quat_to_ypr(quat)
+    [yaw, pitch, roll] = quat_to_ypr(quat) if angles is None else angles
 
     glClear(GL_COLOR_BUFFER_BIT | GL_DEPTH_BUFFER_BIT)
     glLoadIdentity()
@@ -65,48 +98,17 @@ def draw(quat) -> None:
     # glRotatef(pitch, 1.00, 0.00, 0.00)
     # glRotatef(roll , 0.00, 1.00, 0.00)
 
-    glBegin(GL_QUADS)
-
-    glColor3f(0.0, 1.0, 0.0)
-    glVertex3f(1.0, 0.2, -1.0)
-    glVertex3f(-1.0, 0.2, -1.0)
-    glVertex3f(-1.0, 0.2, 1.0)
-    glVertex3f(1.0, 0.2, 1.0)
-
-    glColor3f(1.0, 0.5, 0.0)
-    glVertex3f(1.0, -0.2, 1.0)
-    glVertex3f(-1.0, -0.2, 1.0)
-    glVertex3f(-1.0, -0.2, -1.0)
-    glVertex3f(1.0, -0.2, -1.0)
-
-    glColor3f(1.0, 0.0, 0.0)
-    glVertex3f(1.0, 0.2, 1.0)
-    glVertex3f(-1.0, 0.2, 1.0)
-    glVertex3f(-1.0, -0.2, 1.0)
-    glVertex3f(1.0, -0.2, 1.0)
-
-    glColor3f(1.0, 1.0, 0.0)
-    glVertex3f(1.0, -0.2, -1.0)
-    glVertex3f(-1.0, -0.2, -1.0)
-    glVertex3f(-1.0, 0.2, -1.0)
-    glVertex3f(1.0, 0.2, -1.0)
-
-    glColor3f(0.0, 0.0, 1.0)
-    glVertex3f(-1.0, 0.2, 1.0)
-    glVertex3f(-1.0, 0.2, -1.0)
-    glVertex3f(-1.0, -0.2, -1.0)
-    glVertex3f(-1.0, -0.2, 1.0)
-
-    glColor3f(1.0, 0.0, 1.0)
-    glVertex3f(1.0, 0.2, -1.0)
-    glVertex3f(1.0, 0.2, 1.0)
-    glVertex3f(1.0, -0.2, 1.0)
-    glVertex3f(1.0, -0.2, -1.0)
-
-    glEnd()
+    global _box_list
+    if _box_list is None:
+        _box_list = compileBox()
+    glCallList(_box_list)
 
 
 def initWindow():
+    global _box_list
+    _box_list = None
+    _glyph_bases.clear()
+
     glShadeModel(GL_SMOOTH)
     glClearColor(0.0, 0.0, 0.0, 0.0)
     glClearDepth(1.0)
@@ -126,50 +128,23 @@ def resizewin(width, height):
     glLoadIdentity()
 
 
-def process_data(acc_path: str, gyro_path: str, mag_path: str, frame="NED") -> np.ndarray:
-    # process data
-    acc = pd.read_csv(f"../data/{acc_path}")
-    gyro = pd.read_csv(f"../data/{gyro_path}")
-    mag = pd.read_csv(f"../data/{mag_path}")
-    print(f"Process data called ? Read sensor data")
-
-    # drop timestamp column
-    acc.drop(["Timestamp"], axis=1, inplace=True)
-    gyro.drop(["Timestamp"], axis=1, inplace=True)
-    mag.drop(["Timestamp"], axis=1, inplace=True)
-
-    # find the min shape, some sensors have less samples
-    num_samples = min(acc.shape[0], gyro.shape[0], mag.shape[0])
+def process_data(acc_path: str, gyro_path: str = None, mag_path: str = None, frame="NED") -> np.ndarray:
+    # offline only, kept out of the module imports so the live viewers don't load pandas and ahrs
+    from attitude import rpy
+    from imu_log import ColumnarLog, COLUMNAR_SUFFIX
+    from orientation_cache import csv_orientations
 
-    # reshape all sensors to same no of samples
-    acc.drop(acc.index[num_samples:], inplace=True)
-    gyro.drop(gyro.index[num_samples:], inplace=True)
-    mag.drop(mag.index[num_samples:], inplace=True)
-
-    assert acc.shape == mag.shape == gyro.shape
-
-    # convert to np.ndarray
-    acc_list = acc.to_numpy()
-    gyro_list = gyro.to_numpy()
-    mag_list = mag.to_numpy()
-    print(acc_list[:2])
-    print(gyro_list[:2])
-    print(mag_list[:2])
+    if acc_path.endswith(COLUMNAR_SUFFIX):
+        # columnar logs already store the orientation estimates, computed in the NED frame
+        log = ColumnarLog(f"../data/{acc_path}")
+        return rpy(log.quat)
 
+    # process data, gyro and mag are resampled onto the acc timestamps
+    # the filter only runs the first time these files are seen, later calls map the cached angles
     print("Getting orientation estimates")
-
-    Q = []
-    ekf = EKF()
-    initial = acc2q(acc_list[0])
-    Q.append(initial)
-    for t in range(1, 2):
-        estimate = ekf.update(Q[-1], gyro_list[t], acc_list[t])
-        print(estimate)
-        Q.append(estimate)
-
-    # get orientation estimates for each sensor sample
-    ekf = EKF(gyr=gyro_list, acc=acc_list, mag=mag_list, frame=frame)
-    euler_angles = QuaternionArray(ekf.Q).to_angles()
+    euler_angles = csv_orientations(
+        f"../data/{acc_path}", f"../data/{gyro_path}", f"../data/{mag_path}", frame=frame
+    )["euler"]
     print("Converted quaternions to euler angles")
 
     return euler_angles
@@ -0,0 +1,215 @@
+"""
+Content addressed cache of offline orientation estimates
+
+Running the filter over a whole log is by far the slowest part of opening
+it. Results are stored as .npy files named by a hash of the input files'
+contents and the filter parameters, so a log that was processed before
+is only mapped from disk, and an edited log or a different filter setup
+is a miss instead of a stale hit. The least recently used entries are
+deleted once the cache grows past its size limit.
+
+    python orientation_cache.py           # list entries
+    python orientation_cache.py --clear
+"""
+import hashlib
+import json
+import os
+
+import numpy as np
+
+from attitude import rpy
+
+# bump when the filters or loaders change what they compute, old entries then never match
+CACHE_VERSION = 1
+CACHE_DIR = os.environ.get("IMU_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "imu-robot-controller"))
+MAX_BYTES = int(float(os.environ.get("IMU_CACHE_MAX_MB", "512")) * 1024 * 1024)
+
+_CHUNK = 1 << 20
+
+
+def file_digest(path: str) -> str:
+    """ sha256 of a file's contents """
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(_CHUNK), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def cache_key(paths, **params) -> str:
+    """ Key of the results computed from the files at `paths` with `params` """
+    description = {
+        "version": CACHE_VERSION,
+        "inputs": [file_digest(path) for path in paths],
+        "params": params,
+    }
+    return hashlib.sha256(json.dumps(description, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+class OrientationCache:
+    """
+    Directory of <key>.<name>.npy arrays
+
+    An entry is every array stored under one key. Hits are returned as
+    read-only memory maps and mark the entry as used, eviction removes
+    whole entries, least recently used first.
+    """
+
+    def __init__(self, directory: str = CACHE_DIR, max_bytes: int = MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+
+    def _path(self, key: str, name: str) -> str:
+        return os.path.join(self.directory, f"{key}.{name}.npy")
+
+    def load(self, key: str, names) -> dict:
+        """ The arrays stored under `key`, None unless all of `names` are there """
+        paths = {name: self._path(key, name) for name in names}
+        try:
+            arrays = {name: np.load(path, mmap_mode="r") for name, path in paths.items()}
+        except (FileNotFoundError, ValueError):
+            # missing, or cut short by a crash while storing
+            return None
+        for path in paths.values():
+            os.utime(path)
+        return arrays
+
+    def store(self, key: str, arrays: dict) -> None:
+        os.makedirs(self.directory, exist_ok=True)
+        for name, array in arrays.items():
+            path = self._path(key, name)
+            # written next to the final name and renamed, readers never see a partial file
+            partial = f"{path}.{os.getpid()}.tmp"
+            with open(partial, "wb") as f:
+                np.save(f, np.ascontiguousarray(array))
+            os.replace(partial, path)
+        self.evict(keep=key)
+
+    def entries(self) -> list:
+        """ (key, bytes, last used) of every entry, least recently used first """
+        if not os.path.isdir(self.directory):
+            return []
+        entries = {}
+        for filename in os.listdir(self.directory):
+            if not filename.endswith(".npy"):
+                continue
+            stat = os.stat(os.path.join(self.directory, filename))
+            key = filename.split(".", 1)[0]
+            size, used = entries.get(key, (0, 0.0))
+            entries[key] = (size + stat.st_size, max(used, stat.st_mtime))
+        return sorted(((key, size, used) for key, (size, used) in entries.items()), key=lambda entry: entry[2])
+
+    def remove(self, key: str) -> None:
+        for filename in os.listdir(self.directory):
+            if filename.startswith(f"{key}."):
+                os.remove(os.path.join(self.directory, filename))
+
+    def evict(self, keep: str = None) -> int:
+        """ Remove least recently used entries until the cache fits, returns the bytes freed """
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        freed = 0
+        for key, size, _ in entries:
+            if total - freed <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            self.remove(key)
+            freed += size
+        return freed
+
+    def clear(self) -> None:
+        for key, _, _ in self.entries():
+            self.remove(key)
+
+    def cached(self, paths, params: dict, names, compute) -> dict:
+        """
+        Arrays `names` computed from the files at `paths` with `params`
+
+        compute: () -> dict of those arrays, only called on a miss
+        """
+        key = cache_key(paths, **params)
+        arrays = self.load(key, names)
+        if arrays is not None:
+            self.hits += 1
+            return arrays
+        self.misses += 1
+        self.store(key, compute())
+        return self.load(key, names)
+
+
+_default = None
+
+
+def default_cache() -> OrientationCache:
+    global _default
+    if _default is None:
+        _default = OrientationCache()
+    return _default
+
+
+# every helper below stores these, so any of them can be asked for
+RESULTS = ("timestamp", "quat", "euler")
+
+
+def csv_orientations(acc_path: str, gyro_path: str, mag_path: str, frequency: float = 100.0, frame: str = "NED", cache: OrientationCache = None) -> dict:
+    """
+    EKF estimates of the three sensor csv exports, resampled onto the acc timestamps
+
+    output: timestamp (N,) in epoch seconds, quat (N, 4), euler (N, 3) in radians
+    """
+
+    def compute():
+        from imu_log import load_aligned_csv_streams
+        from fast_ekf import QuaternionEKF
+
+        timestamp, acc, gyro, mag = load_aligned_csv_streams(acc_path, gyro_path, mag_path)
+        quat = QuaternionEKF(frequency, frame).estimate_all(gyro, acc, mag)
+        return {"timestamp": timestamp, "quat": quat, "euler": rpy(quat)}
+
+    cache = default_cache() if cache is None else cache
+    params = {"source": "csv", "filter": "ekf", "frequency": frequency, "frame": frame}
+    return cache.cached([acc_path, gyro_path, mag_path], params, RESULTS, compute)
+
+
+def json_log_orientations(path: str, frequency: float = 20.0, frame: str = "NED", cache: OrientationCache = None) -> dict:
+    """
+    EKF estimates of a json log
+
+    output: timestamp (N,) seconds from the start, samples 1 / frequency apart,
+            quat (N, 4), euler (N, 3) in radians
+    """
+
+    def compute():
+        from imu_log import load_json_log
+        from fast_ekf import QuaternionEKF
+
+        acc, gyro, mag = load_json_log(path)
+        quat = QuaternionEKF(frequency, frame).estimate_all(gyro, acc, mag)
+        return {"timestamp": np.arange(len(acc)) / frequency, "quat": quat, "euler": rpy(quat)}
+
+    cache = default_cache() if cache is None else cache
+    params = {"source": "json", "filter": "ekf", "frequency": frequency, "frame": frame}
+    return cache.cached([path], params, RESULTS, compute)
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description=f"Cached orientation estimates in {CACHE_DIR} (IMU_CACHE_DIR)")
+    parser.add_argument("--clear", action="store_true", help="delete every entry")
+    args = parser.parse_args()
+
+    cache = default_cache()
+    if args.clear:
+        cache.clear()
+    entries = cache.entries()
+    for key, size, _ in entries:
+        print(f"{key[:16]}  {size / 1024:10.1f} KiB")
+    print(f"{len(entries)} entries, {sum(size for _, size, _ in entries) / 1024 ** 2:.1f} of {cache.max_bytes / 1024 ** 2:.0f} MiB")
+
+
+if __name__ == "__main__":
+    main()
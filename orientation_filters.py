@@ -0,0 +1,412 @@
+"""
+Orientation filters the viewers can switch between
+
+Every filter has the interface of fast_ekf.QuaternionEKF: `reset` from
+the first sample, `update` one sample at a time, `update_many` for a
+burst. Complementary, Mahony and Madgwick are ports of the ahrs filters
+of the same name to Python floats, cheaper per sample than the EKF but
+less accurate. Each filter measures its own cost per sample.
+
+The ported filters are written for one reference frame each, their
+estimates are turned about the vertical into the frame asked for, so
+every filter shows the same heading in the viewers.
+
+Compare accuracy and cost on the recorded streams with
+
+    python orientation_filters.py data/acc.csv data/ang_vel.csv data/mag.csv
+"""
+import abc
+import math
+import time
+
+import numpy as np
+from ahrs.common.orientation import acc2q, am2q, ecompass
+
+FILTER_NAMES = ("ekf", "complementary", "mahony", "madgwick")
+FRAMES = ("NED", "ENU")
+
+
+def _unpack(values):
+    return values.tolist() if isinstance(values, np.ndarray) else [float(v) for v in values]
+
+
+def _product(pw, px, py, pz, qw, qx, qy, qz):
+    """ Hamilton product p q """
+    return (
+        pw * qw - px * qx - py * qy - pz * qz,
+        pw * qx + px * qw + py * qz - pz * qy,
+        pw * qy - px * qz + py * qw + pz * qx,
+        pw * qz + px * qy - py * qx + pz * qw,
+    )
+
+
+def _frame_rotation(native_frame: str, frame: str):
+    """
+    Quaternion turning estimates in `native_frame` into `frame`, None if they are the same
+
+    A quarter turn about the vertical, the same yaw offset ahrs' ecompass
+    puts between its NED and ENU estimates of one sample.
+    """
+    if frame not in FRAMES:
+        raise ValueError(f"Unknown frame {frame!r}, expected one of {FRAMES}")
+    if frame == native_frame:
+        return None
+    half_yaw = math.pi / 4 if frame == "ENU" else -math.pi / 4
+    return (math.cos(half_yaw), 0.0, 0.0, math.sin(half_yaw))
+
+
+class OrientationFilter(abc.ABC):
+    """
+    Base of the filters, keeps the estimate and the cost bookkeeping
+
+    Subclasses implement `_reset` and `_update`, which advance `q` in the
+    filter's `native_frame`. `reset` and `update` return the estimate in
+    `frame`, reused by the next call, copy it to keep it. `cost_us` is the
+    average time per sample spent in `update` and `update_many`.
+    """
+
+    name = None
+    # frame the reference vectors of the filter's equations are given in
+    native_frame = "NED"
+
+    def __init__(self, frequency: float = 100.0, frame: str = None):
+        self.frequency = frequency
+        self.Dt = 1.0 / frequency
+        self.q = np.array([1.0, 0.0, 0.0, 0.0])
+        self.frame = self.native_frame if frame is None else frame
+        self._rotation = _frame_rotation(self.native_frame, self.frame)
+        # q itself when no rotation is needed
+        self.estimate = self.q if self._rotation is None else self.q.copy()
+        # estimates of the last update_many, grown when a bigger batch comes in
+        self._batch = np.empty((0, 4))
+        self.samples = 0
+        self.seconds = 0.0
+
+    @abc.abstractmethod
+    def _reset(self, acc, mag=None) -> None:
+        """ Initial `q` from one accelerometer (and magnetometer) sample """
+
+    @abc.abstractmethod
+    def _update(self, gyr, acc, mag=None, dt: float = None) -> None:
+        """ Advance `q` by one sample, dt None for the nominal 1 / frequency """
+
+    def _output(self) -> np.ndarray:
+        if self._rotation is None:
+            return self.q
+        rw, _, _, rz = self._rotation
+        qw, qx, qy, qz = self.q.tolist()
+        self.estimate[:] = _product(rw, 0.0, 0.0, rz, qw, qx, qy, qz)
+        return self.estimate
+
+    def reset(self, acc, mag=None) -> np.ndarray:
+        self._reset(acc, mag)
+        return self._output()
+
+    def update(self, gyr, acc, mag=None, dt: float = None) -> np.ndarray:
+        started = time.perf_counter()
+        self._update(gyr, acc, mag, dt)
+        estimate = self._output()
+        self.samples += 1
+        self.seconds += time.perf_counter() - started
+        return estimate
+
+    def update_many(self, gyr: np.ndarray, acc: np.ndarray, mag: np.ndarray = None, dt=None) -> np.ndarray:
+        """
+        Run `update` over N x 3 sample arrays in one tight loop
+
+        dt: None for the nominal 1 / frequency, one value for every sample,
+            or N values, e.g. the timestamp differences from a JitterBuffer
+        Returns an N x 4 view of the estimates, reused by the next call
+        """
+        started = time.perf_counter()
+        n = len(acc)
+        if len(self._batch) < n:
+            self._batch = np.empty((max(n, 2 * len(self._batch)), 4))
+        estimates = self._batch[:n]
+        # one conversion per column instead of one per sample
+        gyr, acc = np.asarray(gyr).tolist(), np.asarray(acc).tolist()
+        mag = [None] * n if mag is None else np.asarray(mag).tolist()
+        dt = [dt] * n if dt is None or np.ndim(dt) == 0 else np.asarray(dt, dtype=float).tolist()
+        update, output = self._update, self._output
+        for i in range(n):
+            update(gyr[i], acc[i], mag[i], dt[i])
+            estimates[i] = output()
+        self.samples += n
+        self.seconds += time.perf_counter() - started
+        return estimates
+
+    @property
+    def cost_us(self) -> float:
+        """ Measured microseconds per sample, None before the first batch """
+        return self.seconds / self.samples * 1e6 if self.samples else None
+
+    def estimate_all(self, gyr: np.ndarray, acc: np.ndarray, mag: np.ndarray = None) -> np.ndarray:
+        """ N x 4 estimates for whole recordings, as ahrs' filters compute Q """
+        Q = np.zeros((len(acc), 4))
+        if len(acc) == 0:
+            return Q
+        Q[0] = self.reset(acc[0], None if mag is None else mag[0])
+        Q[1:] = self.update_many(gyr[1:], acc[1:], None if mag is None else mag[1:])
+        return Q
+
+
+class Complementary(OrientationFilter):
+    """
+    ahrs.filters.Complementary, one sample at a time
+
+    Blends the integrated gyro angles with the roll, pitch (and yaw with
+    a magnetometer) seen by the accelerometer and magnetometer.
+    """
+
+    name = "complementary"
+
+    def __init__(self, frequency: float = 100.0, gain: float = 0.9, frame: str = None):
+        super().__init__(frequency, frame)
+        self.gain = gain
+        # roll, pitch, yaw
+        self.angles = [0.0, 0.0, 0.0]
+
+    @staticmethod
+    def am_estimation(acc, mag=None):
+        ax, ay, az = acc
+        a_norm = math.sqrt(ax * ax + ay * ay + az * az)
+        ax, ay, az = ax / a_norm, ay / a_norm, az / a_norm
+        ex = math.atan2(ay, az)
+        ey = math.atan2(-ax, math.sqrt(ay * ay + az * az))
+        ez = 0.0
+        if mag is not None:
+            mx, my, mz = mag
+            m_norm = math.sqrt(mx * mx + my * my + mz * mz)
+            mx, my, mz = mx / m_norm, my / m_norm, mz / m_norm
+            by = my * math.cos(ex) - mz * math.sin(ex)
+            bx = mx * math.cos(ey) + math.sin(ey) * (my * math.sin(ex) + mz * math.cos(ex))
+            ez = math.atan2(-by, bx)
+        return [ex, ey, ez]
+
+    def _publish(self) -> np.ndarray:
+        roll, pitch, yaw = self.angles
+        cy, sy = math.cos(0.5 * yaw), math.sin(0.5 * yaw)
+        cp, sp = math.cos(0.5 * pitch), math.sin(0.5 * pitch)
+        cr, sr = math.cos(0.5 * roll), math.sin(0.5 * roll)
+        w = cy * cp * cr + sy * sp * sr
+        x = cy * cp * sr - sy * sp * cr
+        y = sy * cp * sr + cy * sp * cr
+        z = sy * cp * cr - cy * sp * sr
+        n = math.sqrt(w * w + x * x + y * y + z * z)
+        self.q[:] = (w / n, x / n, y / n, z / n)
+        return self.q
+
+    def _reset(self, acc, mag=None) -> np.ndarray:
+        self.angles = self.am_estimation(_unpack(acc), None if mag is None else _unpack(mag))
+        return self._publish()
+
+    def _update(self, gyr, acc, mag=None, dt: float = None) -> np.ndarray:
+        dt = self.Dt if dt is None else dt
+        acc = _unpack(acc)
+        if not any(acc):
+            return self.q
+        measured = self.am_estimation(acc, None if mag is None else _unpack(mag))
+        gain = self.gain
+        # without a magnetometer yaw is not observed and keeps its initial value
+        axes = 3 if mag is not None else 2
+        for i, g in enumerate(_unpack(gyr)[:axes]):
+            self.angles[i] = (self.angles[i] + g * dt) * gain + measured[i] * (1.0 - gain)
+        return self._publish()
+
+
+class Mahony(OrientationFilter):
+    """ ahrs.filters.Mahony, one sample at a time """
+
+    name = "mahony"
+    # the magnetic reference points along y, north in ENU
+    native_frame = "ENU"
+
+    def __init__(self, frequency: float = 100.0, k_P: float = 1.0, k_I: float = 0.3, frame: str = None):
+        super().__init__(frequency, frame)
+        self.k_P = k_P
+        self.k_I = k_I
+        # estimated gyro bias
+        self.b = [0.0, 0.0, 0.0]
+
+    def _reset(self, acc, mag=None) -> np.ndarray:
+        if mag is not None:
+            q = am2q(np.asarray(acc, dtype=float), np.asarray(mag, dtype=float))
+        else:
+            q = acc2q(np.asarray(acc, dtype=float))
+        self.q[:] = q / np.linalg.norm(q)
+        self.b = [0.0, 0.0, 0.0]
+        return self.q
+
+    def _update(self, gyr, acc, mag=None, dt: float = None) -> np.ndarray:
+        dt = self.Dt if dt is None else dt
+        gx, gy, gz = _unpack(gyr)
+        if gx == 0 and gy == 0 and gz == 0:
+            return self.q
+        ax, ay, az = _unpack(acc)
+        qw, qx, qy, qz = self.q.tolist()
+        a_norm = math.sqrt(ax * ax + ay * ay + az * az)
+        if a_norm > 0:
+            ax, ay, az = ax / a_norm, ay / a_norm, az / a_norm
+            # expected gravity, the last row of the rotation matrix
+            vx = 2.0 * (qx * qz - qw * qy)
+            vy = 2.0 * (qw * qx + qy * qz)
+            vz = 1.0 - 2.0 * (qx * qx + qy * qy)
+            ex, ey, ez = ay * vz - az * vy, az * vx - ax * vz, ax * vy - ay * vx
+            if mag is not None:
+                mx, my, mz = _unpack(mag)
+                m_norm = math.sqrt(mx * mx + my * my + mz * mz)
+                if m_norm > 0:
+                    mx, my, mz = mx / m_norm, my / m_norm, mz / m_norm
+                    r00, r01, r02 = 1.0 - 2.0 * (qy * qy + qz * qz), 2.0 * (qx * qy - qw * qz), 2.0 * (qx * qz + qw * qy)
+                    r10, r11, r12 = 2.0 * (qx * qy + qw * qz), 1.0 - 2.0 * (qx * qx + qz * qz), 2.0 * (qy * qz - qw * qx)
+                    # magnetic field in the earth frame, its horizontal part folded onto one axis
+                    hx = r00 * mx + r01 * my + r02 * mz
+                    hy = r10 * mx + r11 * my + r12 * mz
+                    hz = vx * mx + vy * my + vz * mz
+                    by = math.sqrt(hx * hx + hy * hy)
+                    # expected field back in the sensor frame, R^T [0, by, hz]
+                    wx, wy, wz = r10 * by + vx * hz, r11 * by + vy * hz, r12 * by + vz * hz
+                    n = math.sqrt(wx * wx + wy * wy + wz * wz)
+                    wx, wy, wz = wx / n, wy / n, wz / n
+                    ex += my * wz - mz * wy
+                    ey += mz * wx - mx * wz
+                    ez += mx * wy - my * wx
+            b = self.b
+            dt_ki = self.k_I * dt
+            b[0] -= dt_ki * ex
+            b[1] -= dt_ki * ey
+            b[2] -= dt_ki * ez
+            gx = gx - b[0] + self.k_P * ex
+            gy = gy - b[1] + self.k_P * ey
+            gz = gz - b[2] + self.k_P * ez
+        dw, dx, dy, dz = _product(qw, qx, qy, qz, 0.0, gx, gy, gz)
+        h = 0.5 * dt
+        qw, qx, qy, qz = qw + h * dw, qx + h * dx, qy + h * dy, qz + h * dz
+        n = math.sqrt(qw * qw + qx * qx + qy * qy + qz * qz)
+        self.q[:] = (qw / n, qx / n, qy / n, qz / n)
+        return self.q
+
+
+class Madgwick(OrientationFilter):
+    """ ahrs.filters.Madgwick, one sample at a time """
+
+    name = "madgwick"
+
+    def __init__(self, frequency: float = 100.0, gain_imu: float = 0.033, gain_marg: float = 0.041, frame: str = None):
+        super().__init__(frequency, frame)
+        self.gain_imu = gain_imu
+        self.gain_marg = gain_marg
+
+    def _reset(self, acc, mag=None) -> np.ndarray:
+        if mag is not None:
+            q = ecompass(np.asarray(acc, dtype=float), np.asarray(mag, dtype=float), frame="NED", representation="quaternion")
+        else:
+            q = acc2q(np.asarray(acc, dtype=float))
+        self.q[:] = q / np.linalg.norm(q)
+        return self.q
+
+    def _update(self, gyr, acc, mag=None, dt: float = None) -> np.ndarray:
+        dt = self.Dt if dt is None else dt
+        gx, gy, gz = _unpack(gyr)
+        if gx == 0 and gy == 0 and gz == 0:
+            return self.q
+        qw, qx, qy, qz = self.q.tolist()
+        dw, dx, dy, dz = _product(qw, qx, qy, qz, 0.0, gx, gy, gz)
+        dw, dx, dy, dz = 0.5 * dw, 0.5 * dx, 0.5 * dy, 0.5 * dz
+
+        ax, ay, az = _unpack(acc)
+        a_norm = math.sqrt(ax * ax + ay * ay + az * az)
+        if mag is not None:
+            mx, my, mz = _unpack(mag)
+            m_norm = math.sqrt(mx * mx + my * my + mz * mz)
+            if m_norm == 0:
+                mag = None
+        if a_norm > 0:
+            ax, ay, az = ax / a_norm, ay / a_norm, az / a_norm
+            f0 = 2.0 * (qx * qz - qw * qy) - ax
+            f1 = 2.0 * (qw * qx + qy * qz) - ay
+            f2 = 2.0 * (0.5 - qx * qx - qy * qy) - az
+            # gradient J^T f of the objective function
+            g0 = -2.0 * qy * f0 + 2.0 * qx * f1
+            g1 = 2.0 * qz * f0 + 2.0 * qw * f1 - 4.0 * qx * f2
+            g2 = -2.0 * qw * f0 + 2.0 * qz * f1 - 4.0 * qy * f2
+            g3 = 2.0 * qx * f0 + 2.0 * qy * f1
+            gain = self.gain_imu
+            if mag is not None:
+                gain = self.gain_marg
+                mx, my, mz = mx / m_norm, my / m_norm, mz / m_norm
+                # magnetic field in the earth frame, h = q m q*
+                hw, hx, hy, hz = _product(qw, qx, qy, qz, *_product(0.0, mx, my, mz, qw, -qx, -qy, -qz))
+                bx = math.sqrt(hx * hx + hy * hy)
+                bz = hz
+                f3 = 2.0 * bx * (0.5 - qy * qy - qz * qz) + 2.0 * bz * (qx * qz - qw * qy) - mx
+                f4 = 2.0 * bx * (qx * qy - qw * qz) + 2.0 * bz * (qw * qx + qy * qz) - my
+                f5 = 2.0 * bx * (qw * qy + qx * qz) + 2.0 * bz * (0.5 - qx * qx - qy * qy) - mz
+                g0 += -2.0 * bz * qy * f3 + (-2.0 * bx * qz + 2.0 * bz * qx) * f4 + 2.0 * bx * qy * f5
+                g1 += 2.0 * bz * qz * f3 + (2.0 * bx * qy + 2.0 * bz * qw) * f4 + (2.0 * bx * qz - 4.0 * bz * qx) * f5
+                g2 += (-4.0 * bx * qy - 2.0 * bz * qw) * f3 + (2.0 * bx * qx + 2.0 * bz * qz) * f4 + (2.0 * bx * qw - 4.0 * bz * qy) * f5
+                g3 += (-4.0 * bx * qz + 2.0 * bz * qx) * f3 + (-2.0 * bx * qw + 2.0 * bz * qy) * f4 + 2.0 * bx * qx * f5
+            n = math.sqrt(g0 * g0 + g1 * g1 + g2 * g2 + g3 * g3)
+            if n > 0:
+                dw -= gain * g0 / n
+                dx -= gain * g1 / n
+                dy -= gain * g2 / n
+                dz -= gain * g3 / n
+        qw, qx, qy, qz = qw + dw * dt, qx + dx * dt, qy + dy * dt, qz + dz * dt
+        n = math.sqrt(qw * qw + qx * qx + qy * qy + qz * qz)
+        self.q[:] = (qw / n, qx / n, qy / n, qz / n)
+        return self.q
+
+
+def make_filter(name: str, frequency: float = 100.0, frame: str = "NED") -> OrientationFilter:
+    """ Filter by name, estimating in `frame`, None for the frame the filter is written in (NED for the EKF) """
+    if name == "ekf":
+        from fast_ekf import QuaternionEKF
+
+        return QuaternionEKF(frequency, frame or "NED")
+    filters = {cls.name: cls for cls in (Complementary, Mahony, Madgwick)}
+    if name not in filters:
+        raise ValueError(f"Unknown filter {name!r}, expected one of {FILTER_NAMES}")
+    return filters[name](frequency, frame=frame)
+
+
+def compare_filters(gyr, acc, mag, frequency: float = 100.0) -> dict:
+    """ Cost per sample of every filter, and its largest difference from the ahrs filter it ports """
+    from ahrs import filters
+
+    references = {
+        "ekf": lambda: filters.EKF(gyr=gyr, acc=acc, mag=mag, frequency=frequency).Q,
+        "complementary": lambda: filters.Complementary(gyr=gyr, acc=acc, mag=mag, frequency=frequency).Q,
+        "mahony": lambda: filters.Mahony(gyr=gyr, acc=acc, mag=mag, frequency=frequency).Q,
+        "madgwick": lambda: filters.Madgwick(gyr=gyr, acc=acc, mag=mag, frequency=frequency).Q,
+    }
+    results = {}
+    for name in FILTER_NAMES:
+        # as the ahrs filters compute them, unrotated
+        orientation_filter = make_filter(name, frequency, frame=None)
+        Q = orientation_filter.estimate_all(gyr, acc, mag)
+        results[name] = {
+            "cost_us": orientation_filter.cost_us,
+            "max_abs_diff_from_ahrs": float(np.abs(Q - references[name]()).max()),
+        }
+    return results
+
+
+def main():
+    import argparse
+    import json
+
+    from imu_log import load_csv_streams
+
+    parser = argparse.ArgumentParser(description="Cost and accuracy of every orientation filter on recorded csv streams")
+    parser.add_argument("acc")
+    parser.add_argument("gyro")
+    parser.add_argument("mag")
+    args = parser.parse_args()
+
+    acc, gyro, mag = load_csv_streams(args.acc, args.gyro, args.mag)
+    print(json.dumps(compare_filters(gyro, acc, mag), indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,344 @@
+import threading
+import time
+from collections import deque
+
+import numpy as np
+
+from metrics import NULL_METRICS
+
+# what a full channel does with a new item
+DROP_OLDEST = "drop_oldest"  # evict the oldest pending item
+COALESCE = "coalesce"  # replace everything pending with the new item
+BLOCK = "block"  # wait for the consumer to make room
+POLICIES = (DROP_OLDEST, COALESCE, BLOCK)
+
+
+class ChannelClosed(Exception):
+    pass
+
+
+class Channel:
+    """
+    Bounded FIFO between two pipeline stages
+
+    Counts every item put, taken and dropped by the overflow policy
+    """
+
+    def __init__(self, maxsize: int, policy: str = DROP_OLDEST):
+        if maxsize < 1:
+            raise ValueError(f"Channel maxsize must be positive, got {maxsize}")
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown overflow policy {policy!r}, expected one of {POLICIES}")
+        self.maxsize = maxsize
+        self.policy = policy
+        self._items = deque()
+        self._cond = threading.Condition()
+        self._closed = False
+        self.put_count = 0
+        self.get_count = 0
+        self.dropped = 0
+
+    def put(self, item, timeout: float = None) -> bool:
+        """
+        Add an item, applying the overflow policy when full
+
+        Returns False if the item itself was dropped, which only happens
+        with the block policy on timeout or on a closed channel
+        """
+        with self._cond:
+            if self._closed:
+                self.dropped += 1
+                return False
+            if len(self._items) >= self.maxsize:
+                if self.policy == DROP_OLDEST:
+                    self._items.popleft()
+                    self.dropped += 1
+                elif self.policy == COALESCE:
+                    self.dropped += len(self._items)
+                    self._items.clear()
+                elif not self._cond.wait_for(
+                    lambda: self._closed or len(self._items) < self.maxsize, timeout
+                ) or self._closed:
+                    self.dropped += 1
+                    return False
+            self._items.append(item)
+            self.put_count += 1
+            self._cond.notify_all()
+            return True
+
+    def get(self, timeout: float = None):
+        """ Take the oldest item, waiting for one to arrive """
+        with self._cond:
+            if not self._cond.wait_for(lambda: self._items or self._closed, timeout):
+                raise TimeoutError("No item arrived on channel")
+            if not self._items:
+                raise ChannelClosed()
+            item = self._items.popleft()
+            self.get_count += 1
+            self._cond.notify_all()
+            return item
+
+    def drain(self, max_items: int = None) -> list:
+        """ Take up to max_items pending items without waiting """
+        with self._cond:
+            count = len(self._items) if max_items is None else min(max_items, len(self._items))
+            items = [self._items.popleft() for _ in range(count)]
+            self.get_count += count
+            if count:
+                self._cond.notify_all()
+            return items
+
+    def close(self) -> None:
+        """ Wake up all waiters, pending items can still be taken """
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def stats(self) -> dict:
+        return {
+            "depth": len(self._items),
+            "put": self.put_count,
+            "get": self.get_count,
+            "dropped": self.dropped,
+        }
+
+
+def decode_burst(decode, payloads):
+    """
+    Decode a list of payloads with a batch `decode`, skipping bad ones
+
+    Returns the samples of every good payload as one array and the
+    number of payloads that could not be decoded
+    """
+    try:
+        return decode(payloads), 0
+    except Exception:
+        pass
+    # find the bad payloads, keep the rest of the burst
+    samples, errors = [], 0
+    for payload in payloads:
+        try:
+            samples.append(decode([payload]))
+        except Exception as e:
+            errors += 1
+            print(f"Dropping undecodable payload: {e}")
+    return (np.concatenate(samples) if samples else samples), errors
+
+
+def safe_update(pipeline, *args) -> bool:
+    """
+    pipeline.update(*args), False if it raised
+
+    A sample, or with `batch` the whole burst, the filter chokes on is
+    counted in pipeline.update_errors and skipped, the worker keeps going
+    with the next one.
+    """
+    try:
+        pipeline.update(*args)
+        return True
+    except Exception as e:
+        pipeline.update_errors += 1
+        print(f"Skipping sample the filter failed on: {e!r}")
+        return False
+
+
+class Pipeline:
+    """
+    receive -> decode -> filter -> latest state
+
+    `submit` is called from the network thread and only appends the raw
+    payload to a bounded channel. A decode worker turns payloads into
+    samples and a filter worker feeds them to `update`, which publishes
+    the latest state (e.g. into a RingBuffer read by the renderer).
+
+    Every payload carries its receive time through the stages, so queue
+    waits and stage durations can be recorded into `metrics`.
+
+    With `batch`, each worker takes everything pending at once: `decode`
+    gets a list of payloads and returns one sample array, `update` gets
+    that array. A burst between two frames then costs one decode and one
+    update call instead of one per payload and sample, and the renderer
+    only sees the state after the whole burst. The sample channel then
+    holds decoded batches rather than single samples.
+
+    With a `reorder` JitterBuffer, samples go through it before the
+    filter, in timestamp order, and `update` gets their dt as a second
+    argument: one value per sample, or an array of them with `batch`.
+    """
+
+    def __init__(
+        self,
+        decode,
+        update,
+        payload_queue_size: int = 64,
+        sample_queue_size: int = 256,
+        policy: str = DROP_OLDEST,
+        metrics=NULL_METRICS,
+        batch: bool = False,
+        reorder=None,
+    ):
+        self.decode = decode
+        self.update = update
+        self.batch = batch
+        self.reorder = reorder
+        self.payloads = Channel(payload_queue_size, policy)
+        self.samples = Channel(sample_queue_size, policy)
+        self.decode_errors = 0
+        self.update_errors = 0
+        # receive time of the sample behind the latest published state
+        self.latest_received = None
+        self._threads = []
+
+        self.metrics = metrics
+        metrics.gauge("payload_queue_depth", self.payloads.__len__)
+        metrics.gauge("sample_queue_depth", self.samples.__len__)
+        metrics.gauge("payloads_dropped", lambda: self.payloads.dropped)
+        metrics.gauge("samples_dropped", lambda: self.samples.dropped)
+
+    def start(self) -> None:
+        workers = (self._decode_worker, self._filter_worker)
+        if self.batch:
+            workers = (self._batch_decode_worker, self._batch_filter_worker)
+        if self.reorder is not None:
+            workers = (workers[0], self._reorder_filter_worker)
+        for target, name in zip(workers, ("decode", "filter")):
+            thread = threading.Thread(target=target, name=f"pipeline-{name}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self, timeout: float = 1.0) -> None:
+        self.payloads.close()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+
+    def submit(self, payload, received: float = None) -> bool:
+        """ received: time.perf_counter() when the payload arrived """
+        if received is None:
+            received = time.perf_counter()
+        return self.payloads.put((received, payload))
+
+    def _decode_worker(self) -> None:
+        metrics = self.metrics
+        try:
+            while True:
+                received, payload = self.payloads.get()
+                started = time.perf_counter()
+                try:
+                    samples = self.decode(payload)
+                except Exception as e:
+                    self.decode_errors += 1
+                    print(f"Dropping undecodable payload: {e}")
+                    continue
+                if metrics.enabled:
+                    metrics.observe("payload_queue_wait", started - received)
+                    metrics.observe("decode", time.perf_counter() - started)
+                for sample in samples:
+                    self.samples.put((received, sample))
+        except ChannelClosed:
+            self.samples.close()
+
+    def _filter_worker(self) -> None:
+        metrics = self.metrics
+        try:
+            while True:
+                received, sample = self.samples.get()
+                started = time.perf_counter()
+                if not safe_update(self, sample):
+                    continue
+                self.latest_received = received
+                if metrics.enabled:
+                    metrics.observe("receive_to_filter", started - received)
+                    metrics.observe("filter", time.perf_counter() - started)
+                    # only meaningful when the publisher stamps samples with its epoch time
+                    if sample["timestamp"] > 1e9:
+                        metrics.observe("transport", time.time() - sample["timestamp"])
+        except ChannelClosed:
+            pass
+
+    def _batch_decode_worker(self) -> None:
+        metrics = self.metrics
+        try:
+            while True:
+                pending = [self.payloads.get()] + self.payloads.drain()
+                started = time.perf_counter()
+                samples, errors = decode_burst(self.decode, [payload for _, payload in pending])
+                self.decode_errors += errors
+                if metrics.enabled:
+                    for received, _ in pending:
+                        metrics.observe("payload_queue_wait", started - received)
+                    metrics.observe("decode", (time.perf_counter() - started) / len(pending))
+                if len(samples):
+                    # oldest and newest receive time in the batch
+                    self.samples.put(((pending[0][0], pending[-1][0]), samples))
+        except ChannelClosed:
+            self.samples.close()
+
+    def _batch_filter_worker(self) -> None:
+        metrics = self.metrics
+        try:
+            while True:
+                batches = [self.samples.get()] + self.samples.drain()
+                samples = batches[0][1] if len(batches) == 1 else np.concatenate([s for _, s in batches])
+                oldest, newest = batches[0][0][0], batches[-1][0][1]
+                started = time.perf_counter()
+                if not safe_update(self, samples):
+                    continue
+                self.latest_received = newest
+                if metrics.enabled:
+                    metrics.observe("receive_to_filter", started - oldest)
+                    # per sample, comparable with the unbatched pipeline
+                    metrics.observe("filter", (time.perf_counter() - started) / len(samples))
+                    if samples[-1]["timestamp"] > 1e9:
+                        metrics.observe("transport", time.time() - samples[-1]["timestamp"])
+        except ChannelClosed:
+            pass
+
+    def _reorder_filter_worker(self) -> None:
+        metrics = self.metrics
+        reorder = self.reorder
+        closed = False
+        while not closed:
+            # wake up when the oldest held sample is due even if nothing new arrives
+            try:
+                items = [self.samples.get(reorder.timeout(time.perf_counter()))] + self.samples.drain()
+            except TimeoutError:
+                items = []
+            except ChannelClosed:
+                items, closed = [], True
+            for received, samples in items:
+                if self.batch:
+                    reorder.push(samples, received[1])
+                else:
+                    reorder.push(np.array([samples]), received)
+            now = time.perf_counter()
+            samples, dt, received = reorder.flush(now) if closed else reorder.pop(now)
+            if not len(samples):
+                continue
+            started = time.perf_counter()
+            if self.batch:
+                if not safe_update(self, samples, dt):
+                    continue
+            else:
+                for sample, sample_dt in zip(samples, dt.tolist()):
+                    safe_update(self, sample, sample_dt)
+            self.latest_received = received
+            if metrics.enabled:
+                metrics.observe("receive_to_filter", started - received)
+                metrics.observe("filter", (time.perf_counter() - started) / len(samples))
+                if samples[-1]["timestamp"] > 1e9:
+                    metrics.observe("transport", time.time() - samples[-1]["timestamp"])
+
+    def stats(self) -> dict:
+        stats = {
+            "payloads": self.payloads.stats(),
+            "samples": self.samples.stats(),
+            "decode_errors": self.decode_errors,
+            "update_errors": self.update_errors,
+        }
+        if self.reorder is not None:
+            stats["reorder"] = self.reorder.stats()
+        return stats
@@ -1,5 +1,28 @@
-import paho.mqtt.client as mqtt
+"""
+Load generator for stream/imu consumers
+
+Replays a recording as IMU payloads, in real time, at a multiple of real
+time, or at a fixed rate, e.g.
+
+	python publisher.py data --speed 10 --batch 8
+	python publisher.py logs/log.json --rate 500 --loop 20
+	python publisher.py data --speed 0 --transport websockets --port 8883
+
+and reports the achieved publish throughput once a second.
+"""
+import argparse
+import os
 import time
+
+import numpy as np
+import paho.mqtt.client as mqtt
+
+import imu_codec
+from imu_log import ColumnarLog, COLUMNAR_SUFFIX, load_aligned_csv_streams, load_json_log
+
+imu_topic = "stream/imu"
+
+
 def on_connect(client, userdata, flags, rc):
 	if rc == 0:
 		print("Connected successfully")
@@ -11,17 +34,191 @@ def on_message(client, userdata, msg):
 	print(f"Received msg: {msg.topic} -> {msg.payload.decode('utf-8')}")
 
 
-broker = 'localhost'
-port = 1883
-topic = "sensornode/livestream"
-client = mqtt.Client()
+def load_samples(path: str, frequency: float = 20.0) -> np.ndarray:
+	"""
+	Recording as an array of imu_codec samples with timestamps in seconds from its start
+
+	path: a directory with acc.csv, ang_vel.csv and mag.csv, a json log
+	      (no timestamps, samples are 1 / frequency apart) or a columnar log
+	"""
+	if os.path.isdir(path):
+		timestamp, acc, gyro, mag = load_aligned_csv_streams(*(os.path.join(path, name) for name in ("acc.csv", "ang_vel.csv", "mag.csv")))
+	elif path.endswith(COLUMNAR_SUFFIX):
+		log = ColumnarLog(path)
+		timestamp, acc, gyro, mag = log.timestamp, log.acc, log.gyro, log.mag
+	else:
+		acc, gyro, mag = load_json_log(path)
+		timestamp = np.arange(len(acc)) / frequency
+
+	samples = imu_codec.empty_samples(len(acc))
+	samples["timestamp"] = timestamp - timestamp[0] if len(timestamp) else timestamp
+	samples["acc"], samples["gyro"], samples["mag"] = acc, gyro, mag
+	return samples
+
+
+def paced_times(samples: np.ndarray, speed: float = 1.0, rate: float = None) -> np.ndarray:
+	"""
+	When every sample is replayed, in seconds from the start of the run
+
+	The recorded times divided by `speed`, or 1 / rate seconds apart.
+	speed 0 replays everything at once.
+	"""
+	if rate is not None:
+		return np.arange(len(samples)) / rate
+	if speed == 0:
+		return np.zeros(len(samples))
+	return samples["timestamp"] / speed
+
+
+def schedule(samples: np.ndarray, batch: int, speed: float = 1.0, rate: float = None) -> np.ndarray:
+	"""
+	Send time of every message in seconds from the start of the run
+
+	A message goes out when the last of its samples would have been
+	measured, see paced_times.
+	"""
+	last = np.minimum(np.arange(batch, len(samples) + batch, batch), len(samples)) - 1
+	return paced_times(samples, speed, rate)[last]
+
+
+def packetize(samples: np.ndarray, batch: int, encoding: str = "binary") -> list:
+	""" Encode the recording up front, `batch` samples per message """
+	chunks = [samples[i : i + batch] for i in range(0, len(samples), batch)]
+	if encoding == "binary":
+		return [imu_codec.encode(chunk) for chunk in chunks]
+	return [imu_codec.encode_json(chunk) for chunk in chunks]
+
+
+class ThroughputReport:
+	""" Prints messages and samples per second, and how far the sender is behind schedule """
+
+	def __init__(self, interval: float = 1.0):
+		self.interval = interval
+		self.started = time.perf_counter()
+		self.messages = self.samples = self.bytes = 0
+		self.max_lag = 0.0
+		self._last = self.started
+		self._last_messages = self._last_samples = 0
+
+	def sent(self, samples: int, size: int, lag: float) -> None:
+		self.messages += 1
+		self.samples += samples
+		self.bytes += size
+		self.max_lag = max(self.max_lag, lag)
+		now = time.perf_counter()
+		if now - self._last >= self.interval:
+			elapsed = now - self._last
+			print(
+				f"{(self.messages - self._last_messages) / elapsed:9.0f} msg/s"
+				f" {(self.samples - self._last_samples) / elapsed:9.0f} samples/s"
+				f"  lag {lag * 1e3:7.1f} ms"
+			)
+			self._last, self._last_messages, self._last_samples = now, self.messages, self.samples
+
+	def summary(self) -> dict:
+		elapsed = time.perf_counter() - self.started
+		return {
+			"messages": self.messages,
+			"samples": self.samples,
+			"bytes": self.bytes,
+			"seconds": elapsed,
+			"messages_per_s": self.messages / elapsed if elapsed else None,
+			"samples_per_s": self.samples / elapsed if elapsed else None,
+			"max_lag_ms": self.max_lag * 1e3,
+		}
+
+
+def replay(client, samples, batch: int, payloads, send_times, topic: str = imu_topic, loops: int = 1, stamp: bool = False, qos: int = 0) -> dict:
+	"""
+	Publish the payloads at their send times, `loops` times over
+
+	stamp re-encodes every message with epoch timestamps: the time each
+	sample is due in this run, its timestamp in `samples` after the start
+	of its loop. Consumers can measure transport latency and still filter
+	with the sample spacing, and late sends never make a message overlap
+	the one before.
+	"""
+	report = ThroughputReport()
+	# the next loop starts one message interval after the last message
+	period = send_times[-1] + (send_times[-1] - send_times[0]) / max(1, len(send_times) - 1)
+	clock = time.perf_counter
+	start = clock()
+	epoch = time.time()
+	if stamp:
+		times = samples["timestamp"]
+		stamp_period = times[-1] + (times[-1] - times[0]) / max(1, len(times) - 1)
+	info = None
+	for loop in range(loops):
+		offset = start + loop * period
+		for i, payload in enumerate(payloads):
+			delay = offset + send_times[i] - clock()
+			if delay > 0:
+				time.sleep(delay)
+			if stamp:
+				chunk = samples[i * batch : (i + 1) * batch].copy()
+				chunk["timestamp"] += epoch + loop * stamp_period
+				payload = imu_codec.encode(chunk)
+			info = client.publish(topic, payload, qos=qos)
+			report.sent(min(batch, len(samples) - i * batch), len(payload), max(0.0, -delay))
+	if info is not None:
+		# everything queued has been handed to the socket
+		info.wait_for_publish()
+	return report.summary()
+
+
+def main():
+	parser = argparse.ArgumentParser(description="Replay a recording onto stream/imu as a load generator")
+	parser.add_argument("source", help="directory with acc.csv, ang_vel.csv and mag.csv, a json log or a .imucol log")
+	parser.add_argument("--broker", default="localhost")
+	parser.add_argument("--port", type=int, default=1883)
+	parser.add_argument("--transport", choices=("tcp", "websockets"), default="tcp")
+	parser.add_argument("--topic", default=imu_topic)
+	pacing = parser.add_mutually_exclusive_group()
+	pacing.add_argument("--speed", type=float, default=1.0, help="multiple of real time, 0 sends as fast as possible")
+	pacing.add_argument("--rate", type=float, help="fixed sample rate in Hz, ignoring the recorded times")
+	parser.add_argument("--batch", type=int, default=1, help="samples per message")
+	parser.add_argument("--json", action="store_true", help="send the legacy json payloads instead of binary")
+	parser.add_argument("--loop", type=int, default=1, help="replay the recording this many times")
+	parser.add_argument("--stamp", action="store_true", help="stamp samples with the send time (epoch seconds)")
+	parser.add_argument("--frequency", type=float, default=20.0, help="sample rate of json logs, which have no timestamps")
+	parser.add_argument("--qos", type=int, choices=(0, 1, 2), default=0)
+	args = parser.parse_args()
+
+	if not 1 <= args.batch <= imu_codec.MAX_SAMPLES:
+		parser.error(f"--batch must be between 1 and {imu_codec.MAX_SAMPLES}")
+	if args.stamp and args.json:
+		parser.error("--stamp needs binary payloads")
+	if args.speed < 0:
+		parser.error("--speed must not be negative")
+	if args.rate is not None and args.rate <= 0:
+		parser.error("--rate must be positive")
+	if args.frequency <= 0:
+		parser.error("--frequency must be positive")
+
+	samples = load_samples(args.source, args.frequency)
+	payloads = packetize(samples, args.batch, "json" if args.json else "binary")
+	send_times = schedule(samples, args.batch, args.speed, args.rate)
+	if args.stamp:
+		# stamped samples are spaced as they are replayed, in real time when everything goes out at once
+		samples = samples.copy()
+		samples["timestamp"] = paced_times(samples, args.speed or 1.0, args.rate)
+	print(f"Replaying {len(samples)} samples in {len(payloads)} messages over {send_times[-1]:.1f} s, {args.loop} time(s)")
 
-client.on_connect = on_connect
-client.on_message = on_message
+	client = mqtt.Client(transport=args.transport)
+	client.on_connect = on_connect
+	client.on_message = on_message
+	client.connect(args.broker, args.port)
+	client.loop_start()
 
-client.connect(broker, port)
+	try:
+		summary = replay(client, samples, args.batch, payloads, send_times, args.topic, args.loop, args.stamp, args.qos)
+	finally:
+		# disconnect while the network loop still runs, so the DISCONNECT packet goes out
+		client.disconnect()
+		client.loop_stop()
+	print(f"Sent {summary['messages']} messages ({summary['samples']} samples, {summary['bytes']} bytes) in {summary['seconds']:.2f} s")
+	print(f"{summary['messages_per_s']:.0f} msg/s, {summary['samples_per_s']:.0f} samples/s, max lag {summary['max_lag_ms']:.1f} ms")
 
-for i in range(10):
-	client.publish(topic, f'msg no: {i + 1}')
-	time.sleep(2)
 
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,149 @@
+import os
+import struct
+import threading
+import time
+from datetime import datetime
+
+from pipeline import Channel, ChannelClosed, DROP_OLDEST
+
+# session file layout (little endian)
+#   header: magic "IMUREC", version (u8)
+#   record: receive time (f64), topic length (u16), payload length (u32), topic, payload
+MAGIC = b"IMUREC"
+VERSION = 1
+FILE_HEADER = struct.Struct("<6sB")
+RECORD_HEADER = struct.Struct("<dHI")
+
+
+class SessionRecorder:
+    """
+    Writes raw MQTT messages with their receive time to disk
+
+    `record` only appends to a bounded channel and never blocks; if the
+    disk falls behind the oldest pending messages are dropped and counted.
+    A writer thread batches pending messages into one write and starts a
+    new file once the current one reaches `max_bytes` or `max_seconds`.
+    Without the thread (`start(background=False)`) the owner calls
+    `write_pending` itself, e.g. as a task on the asyncio runtime.
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        max_bytes: int = 64 * 1024 * 1024,
+        max_seconds: float = 600.0,
+        batch_size: int = 512,
+        queue_size: int = 16384,
+    ):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_seconds = max_seconds
+        self.batch_size = batch_size
+        self.channel = Channel(queue_size, DROP_OLDEST)
+        self.files = []
+        self.written = 0
+        self._file = None
+        self._opened_at = 0.0
+        self._thread = None
+
+    def start(self, background: bool = True) -> None:
+        os.makedirs(self.directory, exist_ok=True)
+        if background:
+            self._thread = threading.Thread(target=self._writer, name="recorder", daemon=True)
+            self._thread.start()
+
+    def record(self, topic: str, payload: bytes, received: float = None) -> None:
+        if received is None:
+            received = time.time()
+        self.channel.put((received, topic, payload))
+
+    def close(self, timeout: float = 5.0) -> None:
+        """ Stop accepting messages, write everything pending and close the file """
+        self.channel.close()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+        else:
+            while self.write_pending():
+                pass
+            self._close_file()
+
+    def write_pending(self) -> int:
+        """ Write up to one batch of pending messages without waiting, returns how many """
+        batch = self.channel.drain(self.batch_size)
+        if batch:
+            self._write(batch)
+        return len(batch)
+
+    @property
+    def dropped(self) -> int:
+        return self.channel.dropped
+
+    def _open(self) -> None:
+        name = f"session-{datetime.now():%Y%m%d-%H%M%S}-{len(self.files)}.imurec"
+        path = os.path.join(self.directory, name)
+        self._file = open(path, "wb")
+        self._file.write(FILE_HEADER.pack(MAGIC, VERSION))
+        self._opened_at = time.monotonic()
+        self.files.append(path)
+
+    def _rotate_if_needed(self) -> None:
+        if self._file is None:
+            self._open()
+        elif (
+            self._file.tell() >= self.max_bytes
+            or time.monotonic() - self._opened_at >= self.max_seconds
+        ):
+            self._file.close()
+            self._open()
+
+    def _write(self, batch) -> None:
+        frames = []
+        for received, topic, payload in batch:
+            topic = topic.encode("utf-8")
+            frames.append(RECORD_HEADER.pack(received, len(topic), len(payload)))
+            frames.append(topic)
+            frames.append(payload)
+        self._rotate_if_needed()
+        self._file.write(b"".join(frames))
+        self._file.flush()
+        self.written += len(batch)
+
+    def _writer(self) -> None:
+        try:
+            while True:
+                try:
+                    batch = [self.channel.get(timeout=1.0)]
+                except TimeoutError:
+                    continue
+                batch += self.channel.drain(self.batch_size - 1)
+                self._write(batch)
+        except ChannelClosed:
+            pass
+        finally:
+            self._close_file()
+
+    def _close_file(self) -> None:
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+def read_session(path: str):
+    """ Yield (receive time, topic, payload) for every message in a session file """
+    with open(path, "rb") as f:
+        data = f.read()
+    magic, version = FILE_HEADER.unpack_from(data)
+    if magic != MAGIC:
+        raise ValueError(f"{path} is not a session recording")
+    if version != VERSION:
+        raise ValueError(f"Unsupported session version {version}")
+    offset = FILE_HEADER.size
+    while offset < len(data):
+        received, topic_length, payload_length = RECORD_HEADER.unpack_from(data, offset)
+        offset += RECORD_HEADER.size
+        topic = data[offset : offset + topic_length].decode("utf-8")
+        offset += topic_length
+        payload = data[offset : offset + payload_length]
+        offset += payload_length
+        yield received, topic, payload
@@ -0,0 +1,77 @@
+import numpy as np
+
+
+class RingBuffer:
+    """
+    Preallocated, fixed capacity history of float64 rows
+
+    Every row is stored twice, at slot i and i + capacity, so the newest
+    n <= capacity rows are always one contiguous slice of the storage and
+    can be handed out as a view.
+
+    One writer thread appends, any number of threads read. A row is
+    published by bumping `count` after it has been written, so readers
+    never need a lock. Views returned by `latest` and `window` stay valid
+    until `capacity` more rows have been appended.
+    """
+
+    def __init__(self, capacity: int, width: int = 4):
+        if capacity < 1:
+            raise ValueError(f"RingBuffer capacity must be positive, got {capacity}")
+        self.capacity = capacity
+        self.width = width
+        self._data = np.zeros((2 * capacity, width), dtype=np.float64)
+        # total number of rows ever appended
+        self.count = 0
+
+    def append(self, row) -> None:
+        i = self.count % self.capacity
+        self._data[i] = row
+        self._data[i + self.capacity] = row
+        self.count += 1
+
+    def extend(self, rows) -> None:
+        """
+        Append many rows with a few slice copies instead of one per row
+
+        `count` is bumped once at the end, so readers see the whole batch
+        appear at once. Only the last `capacity` rows are kept.
+        """
+        rows = np.asarray(rows, dtype=np.float64)
+        n = len(rows)
+        if n == 0:
+            return
+        if n > self.capacity:
+            rows = rows[-self.capacity :]
+        start = (self.count + n - len(rows)) % self.capacity
+        head = min(len(rows), self.capacity - start)
+        for offset in (0, self.capacity):
+            self._data[offset + start : offset + start + head] = rows[:head]
+            self._data[offset : offset + len(rows) - head] = rows[head:]
+        self.count += n
+
+    def latest(self) -> np.ndarray:
+        """ View of the newest row """
+        count = self.count
+        if count == 0:
+            raise IndexError("RingBuffer is empty")
+        return self._data[(count - 1) % self.capacity + self.capacity]
+
+    def window(self, n: int) -> np.ndarray:
+        """ View of the newest n rows, oldest first """
+        count = self.count
+        n = min(n, count, self.capacity)
+        end = (count - 1) % self.capacity + self.capacity + 1
+        return self._data[end - n : end]
+
+    def __len__(self) -> int:
+        return min(self.count, self.capacity)
+
+    def __getitem__(self, index: int) -> np.ndarray:
+        # 0 is the oldest row still held, -1 the newest
+        size = len(self)
+        if index < 0:
+            index += size
+        if not 0 <= index < size:
+            raise IndexError("RingBuffer index out of range")
+        return self.window(size)[index]
@@ -0,0 +1,343 @@
+"""
+Latest orientation and slider state in shared memory
+
+One process connects to the broker and runs the filter, e.g.
+
+    python visualise-realtime.py --headless --share
+
+and publishes every new estimate and slider value into a small
+multiprocessing.shared_memory block. Any number of renderers on the same
+machine read it instead of subscribing and filtering themselves:
+
+    python visualise-realtime.py --from-share
+    blender_script.py with SHARED_STATE = "imu_orientation"
+
+The block holds a single fixed size record guarded by a seqlock. The
+writer makes the sequence number odd, updates the fields and makes it
+even again. A reader copies the record and retries if the sequence
+number was odd or changed in the meantime. Readers never block the
+writer or each other, and they only ever see the newest state, never a
+backlog.
+
+Only one writer may run per name, a second one is refused while the
+first one's process is alive. A writer that closes marks the record as
+closed before removing the block, readers then attach to whatever block
+the next writer creates under the same name, as they do when the
+writer's process is gone.
+
+The seqlock relies on the sequence number and the fields becoming
+visible to readers in the order they were written. Python has no memory
+barriers, so this holds on x86 but is not guaranteed on weakly ordered
+CPUs such as ARM.
+"""
+import math
+import os
+import threading
+import time
+from multiprocessing import shared_memory
+
+import numpy as np
+
+DEFAULT_NAME = "imu_orientation"
+
+# bump when STATE_DTYPE changes, readers refuse blocks with another layout
+LAYOUT_VERSION = 2
+
+STATE_DTYPE = np.dtype([
+    # odd while the writer is updating the record
+    ("seq", "<u8"),
+    ("layout", "<u8"),
+    # process id of the writer
+    ("pid", "<i8"),
+    # 1 once the writer closed, the block is about to go away
+    ("closed", "<u8"),
+    # estimates published so far, 0 until the first one
+    ("count", "<u8"),
+    # timestamp of the sample the estimate was filtered from, nan if it had none
+    ("timestamp", "<f8"),
+    # time.time() of the last update
+    ("published", "<f8"),
+    ("quat", "<f8", (4,)),
+    # nan until the first value arrives
+    ("link_angle", "<f8"),
+    ("jaw_angle", "<f8"),
+])
+
+SLIDER_FIELDS = ("link_angle", "jaw_angle")
+
+# reads retried back to back before yielding to the writer
+SPINS = 100
+
+# seconds between a reader's checks whether the writer is gone
+CHECK_INTERVAL = 0.5
+
+# blocks created by writers in this process, the resource tracker must keep them
+_owned = set()
+
+
+def _views(shm) -> dict:
+    """ Numpy views of the whole record and of each of its fields, straight on the shared buffer """
+    if shm.size < STATE_DTYPE.itemsize:
+        raise ValueError(f"Shared memory block {shm.name} is {shm.size} bytes, a record needs {STATE_DTYPE.itemsize}")
+    views = {"record": np.ndarray((), STATE_DTYPE, buffer=shm.buf)}
+    for name, (dtype, offset) in STATE_DTYPE.fields.items():
+        views[name] = np.ndarray(dtype.shape, dtype.base, buffer=shm.buf, offset=offset)
+    return views
+
+
+def _attach(name: str):
+    """ Open an existing block without taking ownership of it """
+    shm = shared_memory.SharedMemory(name)
+    if os.name == "posix" and name not in _owned:
+        # before python 3.13 every process that opens a block registers it with
+        # the resource tracker, which unlinks it when that process exits, i.e.
+        # a reader closing would take the block away from the writer
+        from multiprocessing import resource_tracker
+
+        resource_tracker.unregister(shm._name, "shared_memory")
+    return shm
+
+
+def _alive(pid: int) -> bool:
+    """ Whether the process that wrote `pid` into a record may still be running """
+    if pid <= 0:
+        return False
+    if os.name != "posix":
+        # os.kill would terminate it, and a block outlives no process there anyway
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # running as another user
+        return True
+    return True
+
+
+class SharedStateWriter:
+    """
+    Owner of the block, publishes the newest estimate and slider values
+
+    One writer per name, FileExistsError if another process is already
+    publishing under it. publish may be called from several threads,
+    writers are serialised by a lock, readers never take it.
+    """
+
+    def __init__(self, name: str = DEFAULT_NAME):
+        try:
+            self.shm = shared_memory.SharedMemory(name, create=True, size=STATE_DTYPE.itemsize)
+        except FileExistsError:
+            self.shm = self._take_over(name)
+        self.name = name
+        _owned.add(name)
+        self._lock = threading.Lock()
+        self._fields = _views(self.shm)
+        # carry on from the previous writer's sequence, a reader that copied
+        # the record just before must not see the same number again
+        sequence = int(self._fields["seq"])
+        self._sequence = sequence + (sequence & 1)
+        self.publishes = 0
+
+        with self._lock:
+            fields = dict.fromkeys(SLIDER_FIELDS, math.nan)
+            fields.update(layout=LAYOUT_VERSION, pid=os.getpid(), closed=0, count=0, timestamp=math.nan, published=0.0, quat=(1.0, 0.0, 0.0, 0.0))
+            self._write(fields)
+
+    @staticmethod
+    def _take_over(name: str):
+        """ Open a block left behind by a writer that didn't get to unlink it """
+        shm = _attach(name)
+        try:
+            fields = _views(shm)
+            current = int(fields["layout"]) == LAYOUT_VERSION
+            pid = int(fields["pid"]) if current and not fields["closed"] else 0
+        except ValueError:
+            # smaller than a record, an older layout
+            current, pid = False, 0
+        # the views export the buffer, it can't be closed while they are alive
+        fields = None
+        shm.close()
+        if _alive(pid):
+            raise FileExistsError(f"Shared memory block {name} is in use by process {pid}")
+        shm = shared_memory.SharedMemory(name)
+        if current:
+            return shm
+        # readers refuse it anyway, start over with a block of the current size
+        shm.close()
+        shm.unlink()
+        return shared_memory.SharedMemory(name, create=True, size=STATE_DTYPE.itemsize)
+
+    def _write(self, values: dict) -> None:
+        """ Set fields inside one odd / even window of the sequence number, the caller holds the lock """
+        fields = self._fields
+        seq = fields["seq"]
+        self._sequence += 1
+        seq[...] = self._sequence
+        for field, value in values.items():
+            fields[field][...] = value
+        self._sequence += 1
+        seq[...] = self._sequence
+
+    def publish(self, quat=None, timestamp: float = None, estimates: int = 1, **sliders) -> None:
+        """
+        Update the given fields, the others keep their last value
+
+        quat: newest estimate [w, x, y, z]
+        estimates: how many estimates it is the newest of, added to `count`
+        sliders: link_angle and / or jaw_angle
+        """
+        # everything that can be done up front is, the odd window stays short
+        published = time.time()
+        with self._lock:
+            fields = self._fields
+            if fields is None:
+                return
+            seq = fields["seq"]
+            self._sequence += 1
+            seq[...] = self._sequence
+            if quat is not None:
+                fields["quat"][:] = quat
+                fields["count"][...] += estimates
+            if timestamp is not None:
+                fields["timestamp"][...] = timestamp
+            for field, value in sliders.items():
+                fields[field][...] = value
+            fields["published"][...] = published
+            self._sequence += 1
+            seq[...] = self._sequence
+            self.publishes += 1
+
+    def close(self, unlink: bool = True) -> None:
+        """ Stop publishing, by default the block is removed too, readers move on to the next writer's """
+        with self._lock:
+            if self._fields is None:
+                return
+            self._write({"closed": 1})
+            # the views export the buffer, it can't be closed while they are alive
+            self._fields = None
+            self.shm.close()
+            if unlink:
+                self.shm.unlink()
+            _owned.discard(self.name)
+
+
+class SharedStateReader:
+    """
+    Lock free view of a block published by a SharedStateWriter
+
+    Follows the writer across restarts: once the record says the writer
+    closed, or its process is gone, the name is attached again, which
+    picks up the block of a new writer if there is one. Until then the
+    last state keeps being returned.
+    """
+
+    def __init__(self, name: str = DEFAULT_NAME):
+        self.shm = _attach(name)
+        self.name = name
+        self._fields = _views(self.shm)
+        layout = int(self._fields["layout"])
+        if layout != LAYOUT_VERSION:
+            self.close()
+            raise ValueError(f"Shared memory block {name} has layout {layout}, expected {LAYOUT_VERSION}")
+        # reused by every read
+        self._snapshot = np.zeros((), STATE_DTYPE)
+        self.retries = 0
+        self.reattached = 0
+        self._next_check = time.monotonic() + CHECK_INTERVAL
+
+    @property
+    def version(self) -> int:
+        """ Changes on every publish, for checking whether a read is worth it """
+        return int(self._fields["seq"])
+
+    def read(self, timeout: float = 1.0) -> np.ndarray:
+        """
+        Consistent copy of the record, a 0-d array of STATE_DTYPE
+
+        Overwritten by the next read, copy it to keep it. Retries while
+        the writer is in the middle of an update, which takes microseconds
+        unless the writer was preempted halfway, then this yields so it can
+        finish. Raises TimeoutError if no read got through in `timeout` seconds.
+        """
+        snapshot = self._read(timeout)
+        now = time.monotonic()
+        if now >= self._next_check:
+            # a syscall, not on every read
+            self._next_check = now + CHECK_INTERVAL
+            if (snapshot["closed"] or not _alive(int(snapshot["pid"]))) and self._reattach():
+                snapshot = self._read(timeout)
+        return snapshot
+
+    def _reattach(self) -> bool:
+        """ Switch to the block a new writer published under the name, False if there is none yet """
+        try:
+            shm = _attach(self.name)
+        except FileNotFoundError:
+            return False
+        try:
+            fields = _views(shm)
+            usable = int(fields["layout"]) == LAYOUT_VERSION and not fields["closed"] and _alive(int(fields["pid"]))
+        except ValueError:
+            fields, usable = None, False
+        if not usable:
+            # the same dead block, or one this reader can't use
+            fields = None
+            shm.close()
+            return False
+        old = self.shm
+        self.shm, self._fields = shm, fields
+        old.close()
+        self.reattached += 1
+        print(f"Attached to the new writer of shared memory block {self.name}")
+        return True
+
+    def _read(self, timeout: float) -> np.ndarray:
+        seq, record, snapshot = self._fields["seq"], self._fields["record"], self._snapshot
+        deadline = None
+        while True:
+            for _ in range(SPINS):
+                before = int(seq)
+                if before & 1 == 0:
+                    snapshot[...] = record
+                    if int(seq) == before:
+                        return snapshot
+                self.retries += 1
+            if deadline is None:
+                deadline = time.monotonic() + timeout
+            elif time.monotonic() > deadline:
+                raise TimeoutError(f"Shared memory block {self.name} kept changing for {timeout} s")
+            time.sleep(0)
+
+    def close(self) -> None:
+        if self._fields is not None:
+            self._fields = None
+            self.shm.close()
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Print the state another process publishes to shared memory")
+    parser.add_argument("name", nargs="?", default=DEFAULT_NAME, help="name of the shared memory block")
+    parser.add_argument("--interval", type=float, default=1.0, help="seconds between prints")
+    args = parser.parse_args()
+
+    reader = SharedStateReader(args.name)
+    try:
+        while True:
+            state = reader.read()
+            latest = ", ".join(f"{v:+.4f}" for v in state["quat"])
+            sliders = ", ".join(f"{field} {float(state[field]):.3f}" for field in SLIDER_FIELDS)
+            published = float(state["published"])
+            updated = f"updated {time.time() - published:.3f} s ago" if published else "nothing published yet"
+            print(f"{int(state['count'])} estimates, q [{latest}], {sliders}, {updated}")
+            time.sleep(args.interval)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        reader.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+import json
+
+from pipeline import Channel, COALESCE
+
+
+class SliderChannels:
+    """
+    Newest value of every slider topic, latest value wins
+
+    `put` is called from the network thread and only stores the raw
+    payload in a one slot coalescing Channel per topic, a payload that
+    arrives before the previous one was taken replaces it and is counted
+    as dropped. `take` is called at the redraw rate and decodes only the
+    payloads that are still there, so a fast slider costs one json decode
+    and one pose update per frame no matter how many messages it sends.
+    """
+
+    def __init__(self, keys: dict):
+        """ keys: topic -> key of the value in the topic's json payload """
+        self.keys = dict(keys)
+        self.channels = {topic: Channel(1, COALESCE) for topic in self.keys}
+        # per topic, taken payloads that could not be decoded
+        self.errors = dict.fromkeys(self.keys, 0)
+
+    def put(self, topic: str, payload) -> bool:
+        """ False if `topic` is not a slider topic """
+        channel = self.channels.get(topic)
+        if channel is None:
+            return False
+        channel.put(payload)
+        return True
+
+    def take(self) -> dict:
+        """ topic -> newest value, for the topics that received one since the last take """
+        values = {}
+        for topic, channel in self.channels.items():
+            for payload in channel.drain():
+                try:
+                    values[topic] = float(json.loads(payload)[self.keys[topic]])
+                except (ValueError, KeyError, TypeError) as e:
+                    self.errors[topic] += 1
+                    print(f"Dropping undecodable {topic} payload: {e}")
+        return values
+
+    @property
+    def decode_errors(self) -> int:
+        return sum(self.errors.values())
+
+    @property
+    def dropped(self) -> int:
+        """ Values replaced before they were applied """
+        return sum(channel.dropped for channel in self.channels.values())
+
+    def stats(self) -> dict:
+        stats = {
+            topic: {
+                "received": channel.put_count,
+                # taken and decoded, undecodable payloads are taken too
+                "applied": channel.get_count - self.errors[topic],
+                "dropped": channel.dropped,
+                "decode_errors": self.errors[topic],
+            }
+            for topic, channel in self.channels.items()
+        }
+        stats["decode_errors"] = self.decode_errors
+        return stats
@@ -1,58 +1,191 @@
+import argparse
+
 import numpy as np
-import pandas as pd
-from ahrs.common.orientation import q2rpy
-from ahrs.filters.ekf import EKF
 
 import pygame
 from pygame.locals import *
-from OpenGL.GL import *
-from OpenGL.GLU import *
 
-from opengl import draw, initWindow, resizewin
+from opengl import draw, initWindow, resizewin, quat_to_ypr
+from imu_log import ColumnarLog, COLUMNAR_SUFFIX
+from orientation_cache import json_log_orientations
+from frame_scheduler import FrameScheduler
+
+LOG_PATH = "../logs/log.json"
+
+# seconds of recording skipped by the arrow keys, with and without shift
+SEEK_STEP = 5.0
+SEEK_STEP_LARGE = 30.0
+SPEEDS = (0.125, 0.25, 0.5, 1.0, 2.0, 4.0, 8.0, 16.0, 32.0, 64.0)
 
-def json_to_ndarray(data):
-    """ 
-    Convert python list of python objects to np.ndarray
-    
-    data: [{'x': float, 'y': float, 'z': float}]
-    output: [[x1, y1, z1], [x2, y2, z2], ...]
+HELP = """\
+space       pause / play
+left/right  seek 5 s (shift: 30 s), hold to scrub
+, .         step one sample back / forward
+up/down     faster / slower
+home/end    jump to start / end"""
 
+
+def load_orientations(path, frequency: float = 20.0):
     """
-    tmp = []
-    for row in data.index:
-        msmt = data.loc[row]
-        tmp.append([msmt['x'], msmt['y'], msmt['z']])
-    return np.array(tmp)
+    Orientation estimates of a log and their times
 
-tmp = pd.read_json("../logs/log.json")
+    output: seconds from the start of the log (N,), quaternions (N, 4)
+    json logs have no timestamps, samples are spaced 1 / frequency apart
+    """
+    # columnar logs already store the orientation estimates, they are only mapped
+    if path.endswith(COLUMNAR_SUFFIX):
+        log = ColumnarLog(path)
+        return log.timestamp - log.timestamp[0], log.quat
+    # json logs are filtered once, reopening one maps the cached estimates
+    estimates = json_log_orientations(path, frequency)
+    return estimates["timestamp"], estimates["quat"]
 
-acc = json_to_ndarray(tmp['acc'])
-gyro = json_to_ndarray(tmp['gyro'])
-mag = json_to_ndarray(tmp['mag'])
 
-ekf = EKF(gyr=gyro, acc=acc, mag=mag)
+class Playback:
+    """
+    Position in a recording, advanced by wall clock time times `speed`
 
-def main():
+    The replay loop runs at the display rate and only looks up the sample
+    due at the current position, so at any speed the samples between two
+    frames are skipped instead of drawn, and the cost per frame does not
+    depend on the length of the log.
+    """
+
+    def __init__(self, times: np.ndarray, speed: float = 1.0):
+        if len(times) == 0:
+            raise ValueError("Nothing to replay, the log is empty")
+        self.times = times
+        self.speed = speed
+        self.position = 0.0
+        self.paused = False
+
+    @property
+    def duration(self) -> float:
+        return float(self.times[-1])
+
+    @property
+    def index(self) -> int:
+        """ Last sample at or before the current position """
+        index = np.searchsorted(self.times, self.position, side="right") - 1
+        return int(min(max(index, 0), len(self.times) - 1))
+
+    def advance(self, elapsed: float) -> None:
+        if self.paused:
+            return
+        self.seek_to(self.position + elapsed * self.speed)
+        if self.position >= self.duration:
+            # hold the last frame, space plays again from the start
+            self.paused = True
+
+    def seek_to(self, position: float) -> None:
+        self.position = min(max(position, 0.0), self.duration)
+
+    def seek(self, seconds: float) -> None:
+        self.seek_to(self.position + seconds)
+
+    def step(self, samples: int) -> None:
+        """ Move by whole samples, for scrubbing frame by frame while paused """
+        index = min(max(self.index + samples, 0), len(self.times) - 1)
+        self.position = float(self.times[index])
+
+    def change_speed(self, steps: int) -> None:
+        """ Move `steps` entries up or down SPEEDS """
+        current = int(np.argmin([abs(speed - self.speed) for speed in SPEEDS]))
+        self.speed = SPEEDS[min(max(current + steps, 0), len(SPEEDS) - 1)]
+
+    def toggle(self) -> None:
+        if self.paused and self.position >= self.duration:
+            # play again from the start once the end was reached
+            self.position = 0.0
+        self.paused = not self.paused
+
+    def status(self) -> str:
+        state = "paused" if self.paused else f"x{self.speed:g}"
+        return f"{self.position:7.2f} / {self.duration:.2f} s  sample {self.index + 1} / {len(self.times)}  {state}"
+
+
+def handle_key(playback: Playback, event) -> None:
+    large = event.mod & KMOD_SHIFT
+    if event.key == K_SPACE:
+        playback.toggle()
+    elif event.key == K_LEFT:
+        playback.seek(-(SEEK_STEP_LARGE if large else SEEK_STEP))
+    elif event.key == K_RIGHT:
+        playback.seek(SEEK_STEP_LARGE if large else SEEK_STEP)
+    elif event.key == K_COMMA:
+        playback.step(-1)
+    elif event.key == K_PERIOD:
+        playback.step(1)
+    elif event.key == K_UP:
+        playback.change_speed(1)
+    elif event.key == K_DOWN:
+        playback.change_speed(-1)
+    elif event.key == K_HOME:
+        playback.seek_to(0.0)
+    elif event.key == K_END:
+        playback.seek_to(playback.duration)
+
+
+def replay(Q: np.ndarray, playback: Playback, fps: float = 60.0) -> None:
     pygame.init()
     display = (800, 600)
-    pygame.display.set_mode(display, DOUBLEBUF | OPENGL)
+    pygame.display.set_mode(display, DOUBLEBUF | OPENGL, vsync=1)
+    # holding an arrow key keeps seeking, i.e. scrubs through the log
+    pygame.key.set_repeat(250, 50)
 
     resizewin(800, 600)
     initWindow()
 
+    # the angles shown next to the box, converted for the whole log in one go
+    angles = quat_to_ypr(Q)
+
+    # redraw only when the sample on screen changes, at most fps times a second
+    scheduler = FrameScheduler(fps)
+    caption = None
+    last = pygame.time.get_ticks()
+
     # game loop
-    for i in range(len(ekf.Q)):
-        for event in pygame.event.get():
+    while True:
+        timeout_ms = max(1, int(scheduler.timeout() * 1000))
+        for event in [pygame.event.wait(timeout_ms)] + pygame.event.get():
             if event.type == pygame.QUIT:
                 pygame.quit()
-                quit()
-            
-        draw(q2rpy(ekf.Q[i]))
+                return
+            elif event.type == KEYDOWN:
+                handle_key(playback, event)
+            elif event.type in (pygame.VIDEOEXPOSE, pygame.VIDEORESIZE):
+                scheduler.invalidate()
 
-        pygame.display.flip()
-        pygame.time.wait(100)
-    
-if __name__ == "__main__":
-    main()
+        now = pygame.time.get_ticks()
+        playback.advance((now - last) / 1000.0)
+        last = now
 
+        status = playback.status()
+        if status != caption:
+            pygame.display.set_caption(status)
+            caption = status
 
+        index = playback.index
+        if scheduler.should_draw(index):
+            draw(Q[index], angles[index])
+            pygame.display.flip()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay the orientation estimates of a recorded log", epilog=HELP, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("path", nargs="?", default=LOG_PATH, help=f"json log or *{COLUMNAR_SUFFIX} log")
+    parser.add_argument("--speed", type=float, default=1.0, help="multiple of real time")
+    parser.add_argument("--start", type=float, default=0.0, help="seconds into the log to start at")
+    parser.add_argument("--fps", type=float, default=60.0, help="display rate, samples between frames are skipped")
+    parser.add_argument("--frequency", type=float, default=20.0, help="sample rate of json logs")
+    args = parser.parse_args()
+
+    times, Q = load_orientations(args.path, args.frequency)
+    playback = Playback(times, args.speed)
+    playback.seek_to(args.start)
+    print(HELP)
+    replay(Q, playback, args.fps)
+
+
+if __name__ == "__main__":
+    main()
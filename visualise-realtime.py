@@ -1,47 +1,70 @@
 import time
-import json
+import asyncio
+import threading
 import socket
 import argparse
 
-import numpy as np
-from numpy.core.fromnumeric import resize
 import paho.mqtt.client as mqtt
 
-from ahrs.filters import EKF
-from ahrs.common.quaternion import QuaternionArray
-from ahrs.common.orientation import ecompass, q2rpy, acc2q
-
-import pygame
-from pygame.locals import *
-from OpenGL.GLU import *
-from OpenGL.GLU import *
-
-from opengl import draw, initWindow, resizewin
-import threading, queue
-import csv
-from datetime import datetime
+from orientation_filters import FILTER_NAMES, make_filter
+import imu_codec
+from ring_buffer import RingBuffer
+from jitter_buffer import JitterBuffer
+from pipeline import Pipeline, DROP_OLDEST
+from frame_scheduler import FrameScheduler
+from recorder import SessionRecorder
+from sliders import SliderChannels
+from shared_state import SharedStateWriter, SharedStateReader, DEFAULT_NAME as DEFAULT_SHARE
+from metrics import Metrics, NULL_METRICS
+from multi_imu import ShardedFilterPool, device_topic, device_topic_prefix, device_id_from_topic
+from async_runtime import AsyncPipeline, MqttSocketBridge, PriorityScheduler, PRIORITY_LOG, PRIORITY_RENDER
+import async_runtime
 
 imu_topic = "stream/imu"
 jaw_angle_topic = "stream/jaw_angle"
 link_angle_topic = "stream/link_angle"
 
-q = queue.Queue()
+DEFAULT_PORT = 8883
+
+# pygame and PyOpenGL are only imported once a window is opened, see load_display
+pygame = draw = initWindow = resizewin = None
+
 
-# log_file = open("./logs/log.json", "a")
+def load_display():
+    """ Import the window and drawing modules, headless runs never pay for them """
+    global pygame, draw, initWindow, resizewin
+    if pygame is None:
+        import pygame
+        from opengl import draw, initWindow, resizewin
 
-# def worker():
-#     while True:
-#         measurement = q.get()
-#         # log data to txt file
-#         # print("logging data...")
-#         # acc_log.write(json.dumps(measurement))
-#         json.dump(measurement, log_file)
-#         # print(measurement)
-#         q.task_done()
+
+def default_host() -> str:
+    """ Address of this machine, where the broker usually runs """
+    return socket.gethostbyname_ex(socket.gethostname())[-1][-1]
 
 
 class OrientationViewer:
-    def __init__(self, broker_host: str, broker_port: int):
+    def __init__(
+        self,
+        broker_host: str,
+        broker_port: int,
+        history: int = 1024,
+        queue_size: int = 256,
+        overflow: str = DROP_OLDEST,
+        target_fps: float = 60.0,
+        idle_fps: float = 5.0,
+        vsync: bool = True,
+        recorder: SessionRecorder = None,
+        metrics=NULL_METRICS,
+        workers: int = 0,
+        display_device: str = None,
+        use_asyncio: bool = False,
+        batch: bool = True,
+        filter_name: str = "ekf",
+        headless: bool = False,
+        jitter_latency: float = 0.03,
+        share: str = None,
+    ):
         # initialise mqtt client
         self.client = mqtt.Client(
             client_id="", clean_session=True, userdata=None, transport="websockets"
@@ -58,14 +81,87 @@ class OrientationViewer:
 
         self.is_connected = False
         
-        # orietation estimates
-        self.Q = []
-        # initialise kalman filter object
-        # ? initialise filter object on arrival of first measurement
+        # orietation estimates, only the last `history` are kept
+        self.Q = RingBuffer(history, width=4)
+        # per stage latencies, a no-op unless a Metrics object is passed in
+        self.metrics = metrics
+        self.use_asyncio = use_asyncio
+        # orientation filter, its state is initialised on arrival of first measurement
         # TODO set to frequency of phone sensors
-        # self.ekf = EKF(frequency=10)
-
-    def connect_to_broker(self):
+        self.filter = make_filter(filter_name, frequency=20, frame="ENU")
+        metrics.gauge("filter_cost_us", lambda: self.filter.cost_us)
+        # reorder samples by timestamp and filter them with their real dt,
+        # None keeps arrival order and the filter's fixed 1 / frequency
+        self.reorder = None
+        if jitter_latency is not None:
+            self.reorder = JitterBuffer(jitter_latency, nominal_dt=self.filter.Dt, metrics=metrics)
+        # filter everything that arrived since the last pass as one batch
+        decode = imu_codec.decode_many if batch else imu_codec.decode
+        update = self.update_estimates if batch else self.update_estimate
+        if use_asyncio:
+            # network, filter, render and recording share one event loop,
+            # run in priority order by this scheduler
+            self.tasks = PriorityScheduler(metrics)
+            self.pipeline = AsyncPipeline(
+                self.tasks,
+                decode,
+                update,
+                payload_queue_size=queue_size,
+                metrics=metrics,
+                batch=batch,
+                reorder=self.reorder,
+            )
+        else:
+            # decode and filter off the network thread, through bounded queues
+            self.pipeline = Pipeline(
+                decode,
+                update,
+                payload_queue_size=queue_size,
+                sample_queue_size=queue_size,
+                policy=overflow,
+                metrics=metrics,
+                batch=batch,
+                reorder=self.reorder,
+            )
+        # redraw only on new estimates, paced to the target frame rate
+        self.scheduler = FrameScheduler(target_fps, idle_fps)
+        self.vsync = vsync
+        # optional background recording of every received message
+        self.recorder = recorder
+        # stream/imu/<device_id> topics are filtered per device on a process pool
+        self.devices = None
+        if workers:
+            self.devices = ShardedFilterPool(workers, history, queue_size, filter_name=filter_name, jitter_latency=jitter_latency)
+        if display_device is not None and self.devices is None:
+            raise ValueError("Showing a device needs at least one filter worker")
+        # None shows the estimates from the plain stream/imu topic
+        self.display_device = display_device
+        # ingest and filter only, the estimates are reported on stdout
+        self.headless = headless
+        self._reported = (time.perf_counter(), 0)
+        # newest estimate and slider values of the plain stream, published to a
+        # shared memory block for renderers in other processes, see shared_state
+        self.share = None
+        self.sliders = None
+        self._share_lock = threading.Lock()
+        if share is not None:
+            self.share = SharedStateWriter(share)
+            self.sliders = SliderChannels({link_angle_topic: "link_angle", jaw_angle_topic: "jaw_angle"})
+            print(f"Publishing the orientation to shared memory block {share}")
+
+    def connect_to_broker(self, duration: float = None):
+        """ duration: seconds to run headless for, until Ctrl+C if None """
+        if self.use_asyncio:
+            async_runtime.run(self.run_async(duration))
+            return
+
+        self.pipeline.start()
+        if self.recorder is not None:
+            self.recorder.start()
+        topics = [imu_topic, jaw_angle_topic, link_angle_topic]
+        if self.devices is not None:
+            self.devices.start()
+            topics.append(device_topic)
         
         self.client.connect(self.broker_host, self.broker_port)
 
@@ -74,23 +170,101 @@ class OrientationViewer:
         self.client.loop_start()
 
         # subscribe to the sensornode/livestream topic
-        print(f"Subscribing to topics: {imu_topic}, {jaw_angle_topic}, {link_angle_topic}")
-        self.client.subscribe([(imu_topic, 0), (jaw_angle_topic, 0), (link_angle_topic, 0)])
+        print(f"Subscribing to topics: {', '.join(topics)}")
+        self.client.subscribe([(topic, 0) for topic in topics])
+
+        if self.headless:
+            self.run_headless(duration)
+        else:
+            # start visualisation
+            self.start()
+
+    async def run_async(self, duration: float = None):
+        """ Same as connect_to_broker, with everything driven by one event loop """
+        loop = asyncio.get_running_loop()
+        MqttSocketBridge(self.client, loop)
+        self.pipeline.start()
+        if self.recorder is not None:
+            # written in batches by a low priority task rather than a thread
+            self.recorder.start(background=False)
+            self.tasks.add("record", self.recorder.write_pending, PRIORITY_LOG, interval=0.1)
+        topics = [imu_topic, jaw_angle_topic, link_angle_topic]
+        if self.devices is not None:
+            self.devices.start()
+            topics.append(device_topic)
+
+        self.client.connect(self.broker_host, self.broker_port)
+        print(f"Subscribing to topics: {', '.join(topics)}")
+        self.client.subscribe([(topic, 0) for topic in topics])
 
-        # start visualisation
-        self.start()
+        if self.headless:
+            self.tasks.add("status", self.report_status, PRIORITY_LOG, interval=1.0)
+            if duration is not None:
+                loop.call_later(duration, self.tasks.stop)
+        else:
+            self.init_display()
+            # the frame scheduler decides how long until the next frame is worth a look
+            self.tasks.add("render", self.render_tick, PRIORITY_RENDER, interval=self.scheduler.timeout)
+        try:
+            await self.tasks.run()
+        finally:
+            if pygame is not None:
+                pygame.quit()
+            self.disconnect_from_broker()
+
+    def run_headless(self, duration: float = None):
+        """ Wait on the main thread while the pipeline filters, reporting once a second """
+        deadline = None if duration is None else time.monotonic() + duration
+        try:
+            while deadline is None or time.monotonic() < deadline:
+                remaining = 1.0 if deadline is None else deadline - time.monotonic()
+                time.sleep(max(0.0, min(1.0, remaining)))
+                self.report_status()
+        except KeyboardInterrupt:
+            pass
+        self.disconnect_from_broker()
+
+    def report_status(self):
+        """ Print the estimate rate and the latest estimate of the displayed stream """
+        if self.share is not None:
+            self.share_state()
+        history, _ = self.displayed()
+        count = 0 if history is None else history.count
+        now = time.perf_counter()
+        since, reported = self._reported
+        self._reported = (now, count)
+        rate = (count - reported) / (now - since)
+        latest = ", ".join(f"{v:+.4f}" for v in history[-1]) if count else "none yet"
+        print(f"{count} estimates, {rate:.1f}/s, latest q [{latest}]")
 
     def on_subscribe(self, client, userdata, mid, granted_qos):
         print(mid)
 
     def disconnect_from_broker(self):
         if self.is_connected:
-            self.client.loop_stop()
+            if self.use_asyncio:
+                self.client.disconnect()
+            else:
+                self.client.loop_stop()
+            self.pipeline.stop()
             self.is_connected = False
+            print(f"Pipeline stats: {self.pipeline.stats()}")
+            print(f"Filter {self.filter.name}: {self.filter.cost_us} us per sample")
+            if self.devices is not None:
+                self.devices.stop()
+                print(f"Device stats: {self.devices.stats()}")
+            if self.recorder is not None:
+                # flushes everything still pending to disk
+                self.recorder.close()
+                print(f"Recorded {self.recorder.written} messages to {self.recorder.files}, dropped {self.recorder.dropped}")
             print("Disconnected from broker")
             # print(self.Q)
         else:
             print("You haven't connected to the broker yet !")
+        if self.share is not None:
+            self.share_state()
+            print(f"Shared {self.share.publishes} updates, slider stats: {self.sliders.stats()}")
+            self.share.close()
 
     def on_connect(self, client, userdata, flags, rc):
         if rc == 0:
@@ -100,37 +274,28 @@ class OrientationViewer:
             print(f"Connect returned result code {str(rc)}")
 
     def on_message(self, client, userdata, msg):
-        decoded_msg = msg.payload.decode("utf-8")
-        # print(msg.topic, decoded_msg)
-        if msg.topic == link_angle_topic:
-            pass
-        elif msg.topic == jaw_angle_topic:
-            pass
+        # print(msg.topic, msg.payload)
+        if self.recorder is not None:
+            self.recorder.record(msg.topic, msg.payload)
+        if msg.topic in (link_angle_topic, jaw_angle_topic):
+            if self.share is not None:
+                # decoded and published along with the next estimate
+                self.sliders.put(msg.topic, msg.payload)
         elif msg.topic == imu_topic:
-            sensor_data = json.loads(decoded_msg)
-            # print(sensor_data)
-            # add to queue for logging
-            q.put(sensor_data)
-            self.update_estimate(sensor_data)
-
-    def update_estimate(self, measurement):
-        
-        acc, gyro, mag = measurement["acc"], measurement["gyro"], measurement["mag"]
+            # decoded and filtered by the pipeline workers
+            self.pipeline.submit(msg.payload, time.perf_counter())
+        elif self.devices is not None and msg.topic.startswith(device_topic_prefix):
+            # decoded and filtered by the worker owning this device
+            self.devices.submit(device_id_from_topic(msg.topic), msg.payload, time.perf_counter())
 
-        acc = np.array([acc["x"], acc["y"], acc["z"]])
-        gyro = np.array([gyro["x"], gyro["y"], gyro["z"]])
-        mag = np.array([mag["x"], mag["y"], mag["z"]])
+    def update_estimate(self, sample, dt: float = None):
+        # sample is a record of imu_codec.SAMPLE_DTYPE, fields are views into the payload
+        acc, gyro, mag = sample["acc"], sample["gyro"], sample["mag"]
 
         if len(self.Q) == 0:
             # this is the first measurement
-            # initialising the filter expects arguments as N x 3 array
-            acc = np.array([acc])
-            gyro = np.array([gyro])
-            mag = np.array([mag])
-
-            # initialise filter object on first measure
-            self.ekf = EKF(gyr=gyro, acc=acc, mag=mag, frequency=20, frame="ENU")
-            estimate = self.ekf.Q[0]
+            # initialise filter state on first measure
+            estimate = self.filter.reset(acc, mag)
 
             # estimate orientation with acc and mag
             # estimate = ecompass(acc, mag, representation="quaternion")
@@ -139,55 +304,198 @@ class OrientationViewer:
             # estimate = acc2q(acc)
 
         else:
-            # run the update step of the kalman filter,
+            # run the update step of the filter,
             # using the apriori estimate and current sensor measurements
-            # estimate = self.ekf.update(q=self.Q[-1], gyr=gyro, acc=acc)
-            estimate = self.ekf.update(q=self.Q[-1], gyr=gyro, acc=acc, mag=mag)
+            # the filter carries the apriori estimate (self.Q[-1]) in its own state
+            # estimate = self.filter.update(gyro, acc)
+            estimate = self.filter.update(gyro, acc, mag, dt)
 
         # store it the orientation estimate for the next timestep
         self.Q.append(estimate)
+        if self.share is not None:
+            self.share_state(estimate, sample["timestamp"])
 
-    def start(self):
+    def update_estimates(self, samples, dt=None):
+        """ Filter a whole burst in one loop, the history gets a single bulk append """
+        if len(self.Q) == 0:
+            self.update_estimate(samples[0])
+            samples = samples[1:]
+            dt = None if dt is None else dt[1:]
+        if len(samples):
+            estimates = self.filter.update_many(samples["gyro"], samples["acc"], samples["mag"], dt)
+            self.Q.extend(estimates)
+            if self.share is not None:
+                # readers only want the newest, one publish per burst
+                self.share_state(estimates[-1], samples["timestamp"][-1], len(estimates))
+
+    def share_state(self, estimate=None, timestamp: float = None, estimates: int = 1):
+        """
+        Publish to the shared block, with the slider values that came in since the last publish
+
+        Sliders are taken here, at the filter rate, so a fast slider costs
+        one decode per publish. Without an estimate only pending sliders
+        are published, the status report and the render loop call it so
+        they still get through while the imu stream is idle.
+        """
+        # also called from the main thread, a value taken earlier must not be published after a newer one
+        with self._share_lock:
+            values = self.sliders.take()
+            if estimate is None and not values:
+                return
+            sliders = {self.sliders.keys[topic]: value for topic, value in values.items()}
+            self.share.publish(estimate, timestamp, estimates, **sliders)
+
+    def displayed(self):
+        """ History and latest receive time of the estimates being shown """
+        if self.display_device is None:
+            return self.Q, self.pipeline.latest_received
+        history = self.devices.history_of(self.display_device)
+        return history, self.devices.latest_received.get(self.display_device)
+
+    def init_display(self):
+        load_display()
         pygame.init()
         display = (800, 600)
-        pygame.display.set_mode(display, DOUBLEBUF | OPENGL)
+        pygame.display.set_mode(display, pygame.DOUBLEBUF | pygame.OPENGL, vsync=int(self.vsync))
 
         resizewin(800, 600)
         initWindow()
 
+    def handle_events(self, events) -> bool:
+        """ False once the window was closed """
+        for event in events:
+            if event.type == pygame.QUIT:
+                return False
+            elif event.type in (pygame.VIDEOEXPOSE, pygame.VIDEORESIZE):
+                self.scheduler.invalidate()
+        return True
+
+    def render_frame(self):
+        """ Draw the latest estimate if it changed since the last frame """
+        if self.share is not None:
+            self.share_state()
+        history, received = self.displayed()
+
+        # no measurements have been received till now
+        if history is None or len(history) == 0:
+            return
+
+        # count only changes when a new estimate was published
+        if not self.scheduler.should_draw(history.count):
+            return
+
+        # print(q2rpy(history[-1]))
+        frame_started = time.perf_counter()
+        draw(history[-1])
+
+        pygame.display.flip()
+
+        if self.metrics.enabled and received is not None:
+            shown = time.perf_counter()
+            self.metrics.observe("render", shown - frame_started)
+            # from the sample arriving off the network to its estimate on screen
+            self.metrics.observe("motion_to_photon", shown - received)
+
+    def render_tick(self):
+        """ Render task of the asyncio runtime, polls window events instead of waiting on them """
+        if not self.handle_events(pygame.event.get()):
+            self.tasks.stop()
+            return
+        self.render_frame()
+
+    def start(self):
+        self.init_display()
+
         # if we get message from broker, update orientation estimate
         # draw the new orientation
         # * game loop
         while True:
-            for event in pygame.event.get():
+            # sleep until the next frame slot unless a window event comes in
+            # pygame treats a timeout of 0 as "wait forever"
+            timeout_ms = max(1, int(self.scheduler.timeout() * 1000))
+            events = [pygame.event.wait(timeout_ms)] + pygame.event.get()
+            if not self.handle_events(events):
+                pygame.quit()
+                self.disconnect_from_broker()
+                quit()
+
+            self.render_frame()
+
+
+def view_shared(name: str = DEFAULT_SHARE, target_fps: float = 60.0, idle_fps: float = 5.0, vsync: bool = True):
+    """ Render the orientation another process publishes with --share, no broker connection or filter here """
+    reader = SharedStateReader(name)
+    scheduler = FrameScheduler(target_fps, idle_fps)
+    load_display()
+    pygame.init()
+    pygame.display.set_mode((800, 600), pygame.DOUBLEBUF | pygame.OPENGL, vsync=int(vsync))
+    pygame.display.set_caption(f"shared memory {name}")
+    resizewin(800, 600)
+    initWindow()
+    try:
+        while True:
+            # nothing wakes this loop when the writer publishes, it looks once per frame slot
+            timeout_ms = max(1, int(scheduler.timeout() * 1000))
+            for event in [pygame.event.wait(timeout_ms)] + pygame.event.get():
                 if event.type == pygame.QUIT:
-                    pygame.quit()
-                    self.disconnect_from_broker()
-                    quit()
-
-            # no measurements have been received till now
-            if len(self.Q) == 0:
-                continue
-
-            # print(q2rpy(self.Q[-1]))
-            draw(self.Q[-1])
-
-            pygame.display.flip()
-            # pygame.time.wait(16)
-
-
-# threading.Thread(target=worker, daemon=True).start()
-parser = argparse.ArgumentParser()
-
-myIP = socket.gethostbyname_ex(socket.gethostname())[-1][-1]
-PORT = 8883
-viewer = OrientationViewer(myIP, PORT)
-viewer.connect_to_broker()
-
-# block until all sensor data has been logged
-# q.join()
-# close log file
-# log_file.close()
-
-time.sleep(10)
-viewer.disconnect_from_broker()
+                    return
+                elif event.type in (pygame.VIDEOEXPOSE, pygame.VIDEORESIZE):
+                    scheduler.invalidate()
+            state = reader.read()
+            count = int(state["count"])
+            if count and scheduler.should_draw(count):
+                draw(state["quat"])
+                pygame.display.flip()
+    finally:
+        print(f"Read retries: {reader.retries}")
+        reader.close()
+        pygame.quit()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Live orientation of the phone's imu stream")
+    parser.add_argument("--host", help="broker address, defaults to this machine's address")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT, help="broker websocket port")
+    parser.add_argument("--headless", action="store_true", help="ingest and filter without opening a window, print the estimates instead")
+    parser.add_argument("--duration", type=float, help="with --headless, stop after this many seconds")
+    parser.add_argument("--record", metavar="DIR", help="record all received messages to this directory")
+    parser.add_argument("--metrics-port", type=int, help="serve per stage latency metrics as json on this port")
+    parser.add_argument("--workers", type=int, default=0, help="filter processes for stream/imu/<device_id> topics")
+    parser.add_argument("--device", help="show this device instead of the plain stream/imu topic")
+    parser.add_argument("--asyncio", action="store_true", help="run network, filter, render and recording on one event loop")
+    parser.add_argument("--no-batch", action="store_true", help="filter samples one at a time instead of in bursts")
+    parser.add_argument("--jitter-ms", type=float, default=30.0, help="latency budget for putting samples back in timestamp order")
+    parser.add_argument("--fixed-dt", action="store_true", help="filter in arrival order with a fixed dt instead of the sample timestamps")
+    parser.add_argument("--filter", choices=FILTER_NAMES, default="ekf", help="orientation filter, cheaper ones trade accuracy for throughput")
+    parser.add_argument("--share", nargs="?", const=DEFAULT_SHARE, metavar="NAME", help=f"publish the orientation and sliders to this shared memory block (default {DEFAULT_SHARE}) for local renderers")
+    parser.add_argument("--from-share", nargs="?", const=DEFAULT_SHARE, metavar="NAME", help="render what another process publishes with --share instead of connecting to the broker")
+    args = parser.parse_args(argv)
+
+    if args.from_share is not None:
+        view_shared(args.from_share)
+        return
+
+    recorder = SessionRecorder(args.record) if args.record else None
+    metrics = NULL_METRICS
+    if args.metrics_port is not None:
+        metrics = Metrics()
+        metrics.serve(args.metrics_port)
+    viewer = OrientationViewer(
+        args.host or default_host(),
+        args.port,
+        recorder=recorder,
+        metrics=metrics,
+        workers=args.workers or (1 if args.device else 0),
+        display_device=args.device,
+        use_asyncio=args.asyncio,
+        batch=not args.no_batch,
+        filter_name=args.filter,
+        headless=args.headless,
+        jitter_latency=None if args.fixed_dt else args.jitter_ms / 1000,
+        share=args.share,
+    )
+    viewer.connect_to_broker(args.duration)
+
+
+if __name__ == "__main__":
+    main()